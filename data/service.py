@@ -26,20 +26,128 @@ pop-transition - High-permission service
 import dbus
 import dbus.service
 import dbus.mainloop.glib
+import fcntl
+import gc
 import sys
 import time
 import os
+from threading import Thread
 
 from apt.cache import Cache, LockFailedException
+from apt.progress.base import InstallProgress
 import apt_pkg
 from gi.repository import GLib, GObject
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# The package system locks, in the order apt takes them.
+LOCK_FILES = ('/var/lib/dpkg/lock-frontend', '/var/lib/apt/lists/lock')
+
+# How long remove_transaction waits for other programs to release the package 
+# system, in seconds.
+LOCK_TIMEOUT = 1800
+
+# Exit after this many seconds without a request, unless we're holding or 
+# waiting for the lock. D-Bus activation starts us again when needed.
+IDLE_TIMEOUT = 120
+IDLE_CHECK_SECONDS = 15
+
+# The kernel's table of file locks, for finding out which process holds one.
+PROC_LOCKS = '/proc/locks'
+
+def get_lock_holder(path):
+    """ Find the process holding a lock file.
+
+    This reads /proc/locks rather than asking with F_GETLK, because that needs
+    the file open, and closing it again would drop any locks this process
+    holds on it.
+
+    Returns:
+        A (pid, name) tuple, or (0, '') if another process doesn't hold it.
+    """
+    try:
+        info = os.stat(path)
+        with open(PROC_LOCKS) as locks:
+            entries = locks.readlines()
+    except OSError:
+        return (0, '')
+    
+    # Entries look like "1: POSIX  ADVISORY  WRITE 1234 08:02:5678 0 EOF",
+    # and processes waiting for a lock have a "->" entry after the holder's.
+    file_id = (
+        f'{os.major(info.st_dev):02x}:{os.minor(info.st_dev):02x}:'
+        f'{info.st_ino}'
+    )
+    pid = 0
+    for entry in entries:
+        fields = entry.split()
+        if len(fields) < 6 or fields[1] == '->' or fields[5] != file_id:
+            continue
+        try:
+            holder = int(fields[4])
+        except ValueError:
+            continue
+        if holder > 0 and holder != os.getpid():
+            pid = holder
+            break
+    
+    if not pid:
+        return (0, '')
+    
+    try:
+        with open(f'/proc/{pid}/comm') as comm:
+            name = comm.read().strip()
+    except OSError:
+        name = 'unknown'
+    return (pid, name)
+
+def get_memory_usage():
+    """ Returns this process's current and peak memory use, in kB."""
+    usage = {'VmRSS': 0, 'VmHWM': 0}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                key, _, value = line.partition(':')
+                if key in usage:
+                    usage[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return usage
+
+def print_memory_usage(when):
+    usage = get_memory_usage()
+    print(
+        f'Memory {when}: {usage["VmRSS"]} kB resident, '
+        f'{usage["VmHWM"]} kB peak'
+    )
+
+def get_status_mtime():
+    """ Returns the modification time of the dpkg status file, in ns."""
+    try:
+        return os.stat(DPKG_STATUS).st_mtime_ns
+    except OSError:
+        return None
+
+def open_lock_file(path):
+    """ Open a lock file for locking, creating it if needed."""
+    return os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o640)
+
 class TransitionException(dbus.DBusException):
     _dbus_error_name = 'org.pop_os.transition_system.TransitionException'
 
 class PermissionDeniedByPolicy(dbus.DBusException):
     _dbus_error_name = 'org.pop_os.transition_system.PermissionDeniedByPolicy'
 
+class TransactionProgress(InstallProgress):
+    """ Reports dpkg progress as transaction_progress signals."""
+
+    def __init__(self, transition):
+        super().__init__()
+        self.transition = transition
+
+    def status_change(self, pkg, percent, status):
+        self.transition.emit_progress('committing', f'{percent:.0f}% {status}')
+
 class Transition(dbus.service.Object):
     def __init__(self, conn=None, object_path=None, bus_name=None):
         super().__init__(conn, object_path, bus_name)
@@ -47,9 +155,37 @@ class Transition(dbus.service.Object):
         self.dbus_info = None
         self.polkit = None
         self.enforce_polkit = True
-        self.cache = Cache()
+        # The cache is only built when it's first needed, and then kept open 
+        # for as long as the installed packages don't change.
+        self.cache = None
+        self.cache_mtime = None
+        self.cache_metrics = []
         self.lock = None
         self.apt_lock = None
+        self.lock_wait = None
+        self.lock_acquiring = False
+        # The client which the package system is locked for. If it leaves the
+        # bus (even if it crashed), the lock is released.
+        self.lock_owner = None
+
+        # Authorized clients which have made requests. When the last one leaves
+        # the bus, the cache is freed.
+        self.clients = set()
+        self.last_active = time.monotonic()
+        GLib.timeout_add_seconds(IDLE_CHECK_SECONDS, self._check_idle)
+
+        # (sender, privilege) pairs which polkit has already authorized. Unique
+        # bus names are never reused, so an entry is valid until its sender
+        # disconnects from the bus.
+        self.authorized = set()
+        if conn is not None:
+            conn.add_signal_receiver(
+                self._on_name_owner_changed,
+                signal_name='NameOwnerChanged',
+                dbus_interface='org.freedesktop.DBus',
+                bus_name='org.freedesktop.DBus',
+                path='/org/freedesktop/DBus'
+            )
     
     @dbus.service.method(
         'org.pop_os.transition_system.Interface', 
@@ -62,9 +198,15 @@ class Transition(dbus.service.Object):
             sender, conn, 'org.pop_os.transition_system.removedebs'
         )
         print('Obtaining Package manager lock')
+        if self.lock_acquiring:
+            # The waiting thread could get the lock at the same time, and the
+            # process would then hold it twice over.
+            print('Already waiting for the lock')
+            return False
         try:
             self.lock = apt_pkg.get_lock('/var/lib/dpkg/lock-frontend', True)
             self.apt_lock = apt_pkg.get_lock('/var/lib/apt/lists/lock', True)
+            self.lock_owner = sender
             print('Lock obtained')
             return True
         except apt_pkg.Error:
@@ -89,6 +231,7 @@ class Transition(dbus.service.Object):
             os.close(self.apt_lock)
             self.lock = None
             self.apt_lock = None
+            self.lock_owner = None
             print('Lock released')
             return True
         except:
@@ -101,18 +244,71 @@ class Transition(dbus.service.Object):
         sender_keyword='sender', connection_keyword='conn'
     )
     def open_cache(self, sender=None, conn=None):
-        """ Open the package cache. """
+        """ Open the package cache. 
+
+        This only reads the local package lists; it doesn't download anything.
+        Use refresh_cache first to update them.
+        """
         self._check_polkit_privilege(
             sender, conn, 'org.pop_os.transition_system.removedebs'
         )
         if self.lock and self.apt_lock:
-            print('Opening package cache')
-            self.cache.update()
-            self.cache.open()
-            print('Cache open')
+            self._open_cache()
             return True
         print('No lock, cannot open cache')
         return False
+
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='', out_signature='b',
+        sender_keyword='sender', connection_keyword='conn',
+        async_callbacks=('reply', 'error')
+    )
+    def refresh_cache(self, sender=None, conn=None, reply=None, error=None):
+        """ Download the latest package lists from every repository.
+
+        Removing packages doesn't need this, so it's a separate, optional step.
+        It waits for the package system lock like remove_transaction, and still
+        holds it afterwards, so call remove_transaction or release_lock next.
+        Progress is reported with transaction_progress.
+        """
+        self._check_polkit_privilege(
+            sender, conn, 'org.pop_os.transition_system.removedebs'
+        )
+        self.emit_progress('waiting', 'Waiting for the package system lock')
+
+        def refresh(locked, reason):
+            if not locked:
+                error(TransitionException(reason))
+                return
+            
+            failure = None
+            try:
+                self.emit_progress('refreshing', 'Refreshing package lists')
+                if self.cache is None:
+                    self._open_cache()
+                self.cache.update()
+                # The cache needs to be reopened to see the new lists.
+                self.cache_mtime = None
+            except Exception as err:
+                print(f'Could not refresh package lists: {err}')
+                failure = str(err)
+            
+            try:
+                self._relock_lists()
+            except OSError as err:
+                print(f'Could not lock {LOCK_FILES[1]} again: {err}')
+                self.release_lock()
+                failure = failure or f'Could not lock {LOCK_FILES[1]}: {err}'
+            
+            if failure:
+                error(TransitionException(failure))
+                return
+            
+            self.emit_progress('refreshed', 'Package lists refreshed')
+            reply(True)
+
+        self._wait_for_lock(LOCK_TIMEOUT, refresh, sender)
     
     @dbus.service.method(
         'org.pop_os.transition_system.Interface', 
@@ -142,7 +338,9 @@ class Transition(dbus.service.Object):
             sender, conn, 'org.pop_os.transition_system.removedebs'
         )
         if self.lock and self.apt_lock:
-            self.cache.close()
+            if self.cache is not None:
+                self.cache.close()
+                self.cache_mtime = None
             print('Package cache closed')
             return True
         print('No lock, cannot close cache')
@@ -159,17 +357,348 @@ class Transition(dbus.service.Object):
             sender, conn, 'org.pop_os.transition_system.removedebs'
         )
         if self.lock and self.apt_lock:
-            print(f'Marking {package} for removal')
-            try:
-                pkg = self.cache[package]
-                pkg.mark_delete()
-                return pkg.name
-            except:
-                print(f'Could not mark {package} for removal')
-                return ''
+            return self._mark_delete(package)
         print('No lock, cannot mark packages')
         return ''
 
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='as', out_signature='as',
+        sender_keyword='sender', connection_keyword='conn'
+    )
+    def remove_packages(self, packages, sender=None, conn=None):
+        """ Mark a list of packages for removal.
+
+        This only checks authorization once for the whole list. The result has
+        one entry for each requested package: its name if it was marked, or an
+        empty string if it could not be.
+        """
+        self._check_polkit_privilege(
+            sender, conn, 'org.pop_os.transition_system.removedebs'
+        )
+        if self.lock and self.apt_lock:
+            return [self._mark_delete(package) for package in packages]
+        print('No lock, cannot mark packages')
+        return [''] * len(packages)
+
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='as', out_signature='as',
+        sender_keyword='sender', connection_keyword='conn',
+        async_callbacks=('reply', 'error')
+    )
+    def remove_transaction(self, packages, sender=None, conn=None,
+                           reply=None, error=None):
+        """ Remove a list of packages in a single call.
+
+        This locks the package system, opens the cache, marks and removes the
+        packages, then closes the cache and releases the lock, reporting each
+        step with transaction_progress. If another program holds the lock, we
+        keep trying here instead of in the client. The lock is always released
+        before replying.
+
+        Replies with one entry per package, as for remove_packages.
+        """
+        self._check_polkit_privilege(
+            sender, conn, 'org.pop_os.transition_system.removedebs'
+        )
+        self.emit_progress('waiting', 'Waiting for the package system lock')
+        self._wait_for_lock(
+            LOCK_TIMEOUT,
+            lambda locked, reason: self._locked_transaction(
+                locked, reason, packages, reply, error
+            ),
+            sender
+        )
+
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='u', out_signature='b',
+        sender_keyword='sender', connection_keyword='conn',
+        async_callbacks=('reply', 'error')
+    )
+    def wait_for_lock(self, timeout, sender=None, conn=None,
+                      reply=None, error=None):
+        """ Lock the package system, waiting for other programs to finish.
+
+        This replies True as soon as the lock is obtained, or False if it is
+        still held elsewhere after timeout seconds. A timeout of 0 waits
+        forever. The process holding the lock is reported with lock_held.
+        """
+        self._check_polkit_privilege(
+            sender, conn, 'org.pop_os.transition_system.removedebs'
+        )
+        self._wait_for_lock(
+            timeout, lambda locked, reason: reply(locked), sender
+        )
+
+    @dbus.service.signal(
+        'org.pop_os.transition_system.Interface', signature='sus'
+    )
+    def lock_held(self, path, pid, name):
+        """ Reports the process we're waiting on to release a lock."""
+        print(f'{path} is locked by {name} ({pid})')
+
+    @dbus.service.signal(
+        'org.pop_os.transition_system.Interface', signature='ss'
+    )
+    def transaction_progress(self, stage, message):
+        """ Reports the current step of a remove_transaction."""
+        print(f'{stage}: {message}')
+
+    def emit_progress(self, stage, message):
+        """ Emit a transaction_progress signal straight away.
+
+        Transactions block the main loop, so we flush the connection instead of
+        waiting for the main loop to send the signal.
+        """
+        self.transaction_progress(stage, message)
+        self.connection.flush()
+
+    def _locked_transaction(self, locked, reason, packages, reply, error):
+        """ Run the transaction once _wait_for_lock has finished."""
+        if not locked:
+            error(TransitionException(reason))
+            return
+        
+        try:
+            reply(self._run_transaction(packages))
+        except Exception as err:
+            print(f'Transaction failed: {err}')
+            error(TransitionException(str(err)))
+
+    def _relock_lists(self):
+        """ Take the lists lock again after updating the cache.
+
+        Cache.update() takes and closes its own lock on the lists directory,
+        and closing any descriptor for a file drops all of this process's locks
+        on it, including ours. Our descriptor is still open, so the lock is
+        taken again on it. If another program got there first, this raises
+        OSError rather than waiting in the main loop.
+        """
+        if self.apt_lock is None:
+            return
+        fcntl.lockf(self.apt_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _wait_for_lock(self, timeout, callback, sender=None):
+        """ Lock the package system without blocking the main loop.
+
+        A thread blocks in fcntl() until the kernel gives it each lock, so we
+        find out the moment another program releases the package system. The
+        locks belong to this process once the thread has them. 
+
+        fcntl() locks belong to the process rather than the thread, so only one
+        thread ever waits for them; see _acquire_locks. Only the newest request
+        waits, and an older one still waiting is told it was replaced.
+
+        Arguments:
+            timeout (int): Seconds to wait before giving up, or 0 to wait 
+                forever.
+            callback: Called on the main loop as callback(locked, reason), with
+                True once we hold the locks, or with False and the reason if we
+                gave up.
+            sender (str): The client the lock is for. We stop waiting if it
+                leaves the bus, or release the lock if it has it by then.
+        """
+        if self.lock and self.apt_lock:
+            self.lock_owner = sender
+            callback(True, None)
+            return
+        
+        self._stop_waiting(
+            'Another request is now waiting for the package system lock'
+        )
+        waiting = {'timeout_id': None, 'callback': callback, 'sender': sender}
+        self.lock_wait = waiting
+
+        for path in LOCK_FILES:
+            pid, name = get_lock_holder(path)
+            if pid:
+                self.lock_held(path, pid, name)
+                self.emit_progress('waiting', f'Waiting for {name} to finish')
+
+        def give_up():
+            waiting['timeout_id'] = None
+            if self.lock_wait is waiting:
+                print('Timed out waiting for the package system lock')
+                self._stop_waiting(
+                    'Timed out waiting for the package system lock'
+                )
+            return False
+
+        if timeout:
+            waiting['timeout_id'] = GLib.timeout_add_seconds(timeout, give_up)
+        if not self.lock_acquiring:
+            self.lock_acquiring = True
+            Thread(target=self._acquire_locks, daemon=True).start()
+
+    def _acquire_locks(self):
+        """ Wait for both package system locks, in a thread.
+
+        The result is passed to _on_locks_acquired on the main loop: the lock
+        file descriptors, or None with the reason we couldn't lock them, or
+        None and no reason if nobody was waiting for them any more.
+        """
+        # Never wait for the second lock while holding the first, so that
+        # we don't block other programs while we wait.
+        frontend_path, lists_path = LOCK_FILES
+        while self.lock_wait is not None:
+            try:
+                frontend = open_lock_file(frontend_path)
+                fcntl.lockf(frontend, fcntl.LOCK_EX)
+            except OSError as err:
+                print(f'Could not lock {frontend_path}: {err}')
+                GLib.idle_add(
+                    self._on_locks_acquired, None,
+                    f'Could not lock {frontend_path}: {err}'
+                )
+                return
+
+            try:
+                lists = open_lock_file(lists_path)
+            except OSError as err:
+                print(f'Could not lock {lists_path}: {err}')
+                os.close(frontend)
+                GLib.idle_add(
+                    self._on_locks_acquired, None,
+                    f'Could not lock {lists_path}: {err}'
+                )
+                return
+            
+            try:
+                fcntl.lockf(lists, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                GLib.idle_add(self._on_locks_acquired, (frontend, lists), None)
+                return
+            except OSError:
+                os.close(frontend)
+            
+            # Wait for the lists lock, then start over.
+            try:
+                fcntl.lockf(lists, fcntl.LOCK_EX)
+            finally:
+                os.close(lists)
+
+        GLib.idle_add(self._on_locks_acquired, None, None)
+
+    def _on_locks_acquired(self, locks, reason):
+        """ Hand the result of _acquire_locks to whoever is waiting now."""
+        self.lock_acquiring = False
+        waiting = self.lock_wait
+
+        if waiting is None:
+            # Nobody wants them any more. This was the only thread locking, so
+            # closing these can't drop a lock taken for anyone else.
+            for lock in locks or ():
+                os.close(lock)
+            return False
+
+        if locks is None and reason is None:
+            # The thread stopped just before a new request started waiting.
+            self.lock_acquiring = True
+            Thread(target=self._acquire_locks, daemon=True).start()
+            return False
+
+        self.lock_wait = None
+        if waiting['timeout_id']:
+            GLib.source_remove(waiting['timeout_id'])
+        if locks:
+            self.lock, self.apt_lock = locks
+            self.lock_owner = waiting['sender']
+            print('Lock obtained')
+        waiting['callback'](bool(locks), reason)
+        return False
+
+    def _stop_waiting(self, reason):
+        """ Stop waiting for the lock for the current request, if any.
+
+        Its callback is called with False and reason. A thread still blocked in
+        fcntl() can't be interrupted, so it is left to finish by itself.
+        """
+        waiting = self.lock_wait
+        if waiting is None:
+            return
+        self.lock_wait = None
+        if waiting['timeout_id']:
+            GLib.source_remove(waiting['timeout_id'])
+        waiting['callback'](False, reason)
+
+    def _run_transaction(self, packages):
+        """ Remove packages from the system. We must already hold the lock."""
+        removed = [''] * len(packages)
+        try:
+            self.emit_progress('opening', 'Opening the package cache')
+            self._open_cache()
+
+            for index, package in enumerate(packages):
+                self.emit_progress('marking', package)
+                removed[index] = self._mark_delete(package)
+
+            if any(removed):
+                self.emit_progress('committing', 'Removing packages')
+                self.cache.commit(install_progress=TransactionProgress(self))
+        
+        finally:
+            self.emit_progress('releasing', 'Releasing the package system lock')
+            try:
+                # Keep the cache open for the next transaction, without any of
+                # this one's changes.
+                if self.cache is not None:
+                    self.cache.clear()
+            finally:
+                self.release_lock()
+        
+        self.emit_progress('done', 'Finished removing packages')
+        return removed
+
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='', out_signature='a(sdd)'
+    )
+    def get_cache_metrics(self):
+        """ Report how long each request for the package cache took.
+
+        Returns a list of (kind, start time, seconds taken), where kind is 
+        'build' for a new cache, 'reopen' if the installed packages changed,
+        or 'reuse' if the already-open cache was used.
+        """
+        return self.cache_metrics
+
+    def _open_cache(self):
+        """ Get an open package cache, reusing the current one if we can.
+
+        The cache is only reopened if the dpkg status file has changed since it
+        was last opened (or the cache was closed or its lists refreshed).
+        """
+        started = time.time()
+        start = time.perf_counter()
+        status_mtime = get_status_mtime()
+
+        if self.cache is None:
+            kind = 'build'
+            self.cache = Cache()
+        elif status_mtime is None or status_mtime != self.cache_mtime:
+            kind = 'reopen'
+            self.cache.open()
+        else:
+            kind = 'reuse'
+            self.cache.clear()
+        self.cache_mtime = status_mtime
+
+        duration = time.perf_counter() - start
+        self.cache_metrics.append((kind, started, duration))
+        print(f'Package cache {kind} took {duration:.3f}s')
+        return self.cache
+
+    @dbus.service.method(
+        'org.pop_os.transition_system.Interface', 
+        in_signature='', out_signature='a{st}'
+    )
+    def get_memory_usage(self):
+        """ Report the service's resident (VmRSS) and peak (VmHWM) memory use,
+        in kB.
+        """
+        return get_memory_usage()
+
     @dbus.service.method(
         'org.pop_os.transition_system.Interface', 
         in_signature='', out_signature='',
@@ -179,7 +708,74 @@ class Transition(dbus.service.Object):
         if self.lock and self.apt_lock:
             self.close_cache()
             self.release_lock()
+        print_memory_usage('at exit')
+        mainloop.quit()
+
+    def _check_idle(self):
+        """ Exit if nobody has needed us for a while."""
+        if self.lock or self.lock_wait:
+            return True
+        
+        if time.monotonic() - self.last_active < IDLE_TIMEOUT:
+            return True
+        
+        print(f'No requests for {IDLE_TIMEOUT} seconds, exiting')
+        print_memory_usage('at exit')
         mainloop.quit()
+        return False
+
+    def _cleanup_client(self, name):
+        """ Release everything held for a client which has left the bus.
+
+        This covers a client which crashed or quit in the middle of removing
+        packages, so the package system isn't left locked. Other clients don't
+        keep it locked for one which has gone. Once all of them have gone, the
+        cache is freed too.
+        """
+        if self.lock_wait and self.lock_wait['sender'] == name:
+            print('Giving up waiting for the lock')
+            self._stop_waiting('The client disconnected')
+        
+        if self.lock_owner == name and (self.lock or self.apt_lock):
+            self.release_lock()
+        
+        if name not in self.clients:
+            return
+        self.clients.discard(name)
+        if self.clients:
+            return
+        
+        print('All clients have disconnected')
+        self.cache = None
+        self.cache_mtime = None
+        gc.collect()
+        print_memory_usage('after freeing the cache')
+
+    def _mark_delete(self, package):
+        """ Mark a single package for removal in the open cache.
+
+        Returns the name of the package, or an empty string on failure.
+        """
+        print(f'Marking {package} for removal')
+        try:
+            pkg = self.cache[package]
+            pkg.mark_delete()
+            return pkg.name
+        except:
+            print(f'Could not mark {package} for removal')
+            return ''
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        """ Forget the authorizations of clients which leave the bus."""
+        if new_owner:
+            return
+        
+        for authorization in list(self.authorized):
+            if authorization[0] in (name, old_owner):
+                print(f'{name} disconnected, forgetting its authorization')
+                self.authorized.discard(authorization)
+        
+        self._cleanup_client(name)
 
     def _check_polkit_privilege(self, sender, conn, privilege):
         '''Verify that sender has a given PolicyKit privilege.
@@ -195,8 +791,15 @@ class Transition(dbus.service.Object):
             # Called locally, not through D-Bus
             return
         
+        self.last_active = time.monotonic()
+        
         if not self.enforce_polkit:
             # For testing
+            self.clients.add(sender)
+            return
+        
+        if (sender, privilege) in self.authorized:
+            self.clients.add(sender)
             return
         
         if self.dbus_info is None:
@@ -228,6 +831,9 @@ class Transition(dbus.service.Object):
         
         if not is_auth:
             raise PermissionDeniedByPolicy(privilege)
+        
+        self.authorized.add((sender, privilege))
+        self.clients.add(sender)
 
 if __name__ == "__main__":
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -24,15 +24,17 @@ pop-transition - Main Application
 """
 
 import gettext
-import shutil
 from logging import getLogger
 
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, Gio, GLib
 
 from . import apt
+from . import detect
 from . import dismissal
+from . import dispatch
 from . import flatpak
-from .package import Package
+from . import migrate
+from .package import get_installed_packages
 from .window import Window
 from .flathub_dialog import FlathubDialog
 
@@ -50,12 +52,38 @@ def get_flathub_disabled():
 class Application(Gtk.Application):
     """ Application class"""
 
-    def __init__(self, app_list):
-        self.app_list = app_list
+    def __init__(self, app_list, backend=None, refresh_lists=False,
+                 pipeline=False, move_config=False, repair=None,
+                 appstream_max_age=None):
+        self.setup_state(
+            app_list, backend, refresh_lists, pipeline, move_config, repair,
+            appstream_max_age
+        )
         super().__init__(application_id='org.pop_os.transition',
                          flags=Gio.ApplicationFlags.REPLACE)
-        
+    
+    def setup_state(self, app_list, backend=None, refresh_lists=False,
+                    pipeline=False, move_config=False, repair=None,
+                    appstream_max_age=None):
+        """ Set up the options and state shared with Notification.
+
+        The arguments are those of Application. A repair or appstream_max_age
+        of None uses the flatpak module's default.
+        """
         self.log = getLogger('pop-transition.app')
+        self.app_list = app_list
+        self.backend = detect.CachedBackend(
+            detect.get_backend(backend), app_list
+        )
+        self.refresh_lists = refresh_lists
+        self.pipeline = pipeline
+        self.move_config = move_config
+        self.deferred_moves = []
+        self.repair = repair or flatpak.REPAIR_AUTO
+        self.appstream_max_age = appstream_max_age
+        if appstream_max_age is None:
+            self.appstream_max_age = flatpak.APPSTREAM_MAX_AGE
+        self.migrations = []
     
     def do_activate(self):
         self.show_window()
@@ -104,9 +132,8 @@ class Application(Gtk.Application):
     def on_dmismiss_clicked(self, button, window, data=None):
         if not dismissal.is_dismissed():
             dismissal.dismiss_notifications()
-            po = apt.get_privileged_object()
-            po.exit()
-            self.quit()
+            apt.exit_privileged_object()
+            self.quit_after_migrating()
         
         else:
             dismissal.show_notifications()
@@ -129,7 +156,7 @@ class Application(Gtk.Application):
                 package.spinner.stop()
                 package.status = ''
         
-        apt.remove_debs(remove_debs, window)
+        apt.remove_debs(remove_debs, window, refresh=self.refresh_lists)
     
     def on_install_clicked(self, button, window, data=None):
         self.log.info('Install clicked')
@@ -145,49 +172,161 @@ class Application(Gtk.Application):
             else:
                 package.spinner.stop()
                 package.status = ''
-        flatpak.install_flatpaks(install_flatpaks, window)
 
-        for package in window.app_list.packages:
-            if package.checkbox.get_active():
-                if package.old_config and package.new_config:
-                        package.status = 'Migrating configuration'
-                        try:
-                            shutil.copytree(package.old_config, package.new_config)
-                        except shutil.Error:
-                            msg = f'Could not copy config for {package.name} '
-                            msg += f'from {package.old_config} to {package.new_config}.'
-                            self.log.info(msg)
-                        except FileExistsError:
-                            msg = f'Config for {package.name} already exists in '
-                            msg += f'{package.new_config}.'
-                            self.log.error(msg)
+        # When pipelining, each app's deb is removed as soon as its Flatpak is
+        # installed, rather than after all of them from the Apt page.
+        remover = None
+        if self.pipeline and install_flatpaks:
+            remover = apt.pipeline_removals(window, refresh=self.refresh_lists)
+        flatpak.install_flatpaks(
+            install_flatpaks,
+            window,
+            repair=self.repair,
+            appstream_max_age=self.appstream_max_age,
+            remover=remover
+        )
+
+        # Moving the configuration leaves nothing for the Debian package, so
+        # it waits until we know whether that's been removed.
+        copy_configs = install_flatpaks
+        if self.move_config:
+            self.deferred_moves = [
+                package for package in install_flatpaks
+                if package.old_config and package.new_config
+            ]
+            copy_configs = [
+                package for package in install_flatpaks
+                if package not in self.deferred_moves
+            ]
+            for package in self.deferred_moves:
+                package.set_migration_text(
+                    'Configuration will be moved once the Debian package is '
+                    'removed'
+                )
+
+        # Configuration is copied in the background while the Flatpaks are
+        # downloading.
+        self.start_migration(copy_configs)
+    
+    def start_migration(self, packages, move=False):
+        """ Migrate the configuration of packages in the background."""
+        if packages:
+            self.migrations.append(migrate.migrate_configs(
+                packages,
+                move=move,
+                on_progress=self.on_migration_progress,
+                on_finished=self.on_migration_finished
+            ))
+    
+    def finish_migration(self, packages):
+        """ Migrate configuration which was waiting for its Debian package.
+
+        The Remover calls this once removing the Debian packages has been
+        tried. Where that succeeded and the Flatpak is installed, nothing needs
+        the configuration where it was, so it's moved. Otherwise it's copied.
+        """
+        deferred = [
+            package for package in packages if package in self.deferred_moves
+        ]
+        for package in deferred:
+            self.deferred_moves.remove(package)
+
+        move = [
+            package for package in deferred
+            if package.removed
+            and package.installed_status in ('installed', 'already installed')
+        ]
+        self.start_migration(move, move=True)
+        self.start_migration(
+            [package for package in deferred if package not in move]
+        )
+    
+    def copy_deferred_configs(self):
+        """ Copy the configuration which was waiting to be moved.
+
+        Call this when the Debian packages aren't going to be removed after
+        all, so that the Flatpaks still get their configuration.
+        """
+        deferred = self.deferred_moves
+        self.deferred_moves = []
+        self.start_migration(deferred)
+    
+    def quit_after_migrating(self):
+        """ Quit once the configuration has been migrated.
+
+        The window is hidden straight away, but a Flatpak shouldn't be left
+        with only part of its configuration.
+        """
+        self.copy_deferred_configs()
+        if not any(migration.is_alive() for migration in self.migrations):
+            self.quit()
+            return
+        
+        self.log.info('Waiting for configuration to be migrated')
+        self.window.hide()
+        GLib.timeout_add(100, self.on_quit_timeout)
+    
+    def on_quit_timeout(self):
+        """ Quit once every migration has finished."""
+        if any(migration.is_alive() for migration in self.migrations):
+            return True
+        self.quit()
+        return False
+    
+    def on_migration_progress(self, package, migration):
+        """ Show how much configuration has been copied (from its thread)."""
+        done_files = migration.copied_files + migration.skipped_files
+        done_bytes = migration.copied_bytes + migration.skipped_bytes
+        dispatch.update(
+            package.set_migration_text,
+            f'Migrating configuration: {done_files} of '
+            f'{migration.total_files} files, '
+            f'{migrate.format_size(done_bytes)} of '
+            f'{migrate.format_size(migration.total_bytes)}'
+        )
+    
+    def on_migration_finished(self, package, migration, error):
+        """ Show the result of migrating a package (from its thread)."""
+        if error is None and not migration.copied_files:
+            text = 'Configuration already up to date'
+        elif error is None:
+            text = (
+                f'Configuration migrated: {migration.copied_files} files, '
+                f'{migrate.format_size(migration.copied_bytes)} '
+                f'({migration.strategy or "nothing to copy"})'
+            )
+        elif isinstance(error, FileExistsError):
+            text = 'Configuration already migrated'
+        elif isinstance(error, migrate.MigrationCancelled):
+            text = 'Configuration migration cancelled'
+        else:
+            text = 'Some configuration could not be migrated'
+        dispatch.update(package.set_migration_text, text)
     
     def get_installed_packages(self):
         """ Yield a list of installed Packages."""
-        for app in self.app_list:
-            pkg = Package()
-            pkg.name = self.app_list[app]['name']
-            pkg.version = self.app_list[app]['version']
-            pkg.icon = self.app_list[app]['icon']
-            pkg.source = 'Flathub'
-            pkg.app_id = self.app_list[app]['id']
-            pkg.deb_package = self.app_list[app]['deb_pkg']
-            pkg.old_config = self.app_list[app]['old_config']
-            pkg.new_config = self.app_list[app]['new_config']
-            if pkg.installed and pkg.upgrade_origin in ("", "system76", "LP-PPA-system76-pop"):
-                yield pkg
+        return get_installed_packages(self.app_list, self.backend)
+
+    def refresh_packages(self):
+        """ Re-detects the state of the packages shown in the window.
+
+        Packages only store the state detected when they were created, so this
+        needs to be called after making changes to the package system.
+        """
+        self.backend.refresh()
+        packages = [row.package for row in self.window.app_list.packages]
+        detect.detect_packages(packages, self.backend)
 
     def on_quit_clicked(self, button, data=None):
         """ Clicked signal handler for the various 'quit' buttons."""
-        po = apt.get_privileged_object()
-        po.exit()
-        self.quit()
+        apt.exit_privileged_object()
+        self.quit_after_migrating()
 
 class Notification(Application):
     """ Application class, with notification"""
 
-    def __init__(self, app_list):
-        self.app_list = app_list
+    def __init__(self, app_list, backend=None):
+        self.setup_state(app_list, backend)
         Gtk.Application.__init__(self, application_id='org.pop_os.transition',
                          flags=Gio.ApplicationFlags.IS_SERVICE)
     
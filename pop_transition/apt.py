@@ -24,26 +24,63 @@ pop-transition - APT interface module.
 """
 
 from logging import getLogger
-import time
 
-import dbus
-
-from apt.cache import Cache
 import apt_pkg
-from gi.repository.GLib import idle_add
-from threading import Thread
+from gi.repository import Gio, GLib
+
+from . import dispatch
+
+# Both of these are expensive (building the cache parses every package list,
+# and connecting activates the root service), so they're only created on first
+# use. Importing this module must not have any side effects.
+CACHE = None
+privileged_object = None
 
-CACHE = Cache()
-bus = dbus.SystemBus()
-privileged_object = bus.get_object('org.pop_os.transition_system', '/PopTransition')
+# Removing packages can take a long time, so don't let the D-Bus call time out.
+TRANSACTION_TIMEOUT = 3600
 
 def get_privileged_object():
+    """ Returns the Gio.DBusProxy for the privileged transition service.
+
+    The connection is made the first time this is called, and the same proxy is
+    shared afterwards. Calls made through it are asynchronous, with replies and
+    signals delivered on the GLib main loop.
+    """
     global privileged_object
+    if privileged_object is None:
+        privileged_object = Gio.DBusProxy.new_for_bus_sync(
+            Gio.BusType.SYSTEM,
+            Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES,
+            None,
+            'org.pop_os.transition_system',
+            '/PopTransition',
+            'org.pop_os.transition_system.Interface',
+            None
+        )
     return privileged_object
 
+def exit_privileged_object():
+    """ Tells the privileged service to exit, if we've started it."""
+    global privileged_object
+    if privileged_object is not None:
+        try:
+            privileged_object.call_sync(
+                'exit', None, Gio.DBusCallFlags.NO_AUTO_START, 1000, None
+            )
+        except GLib.Error as err:
+            getLogger('pop-transition.apt').warning(
+                'Could not stop the privileged service: %s', err.message
+            )
+        privileged_object = None
+
 def get_cache():
-    """ Returns the currently-open apt.cache.Cache object."""
+    """ Returns the currently-open apt.cache.Cache object.
+
+    The cache is built the first time this is called.
+    """
     global CACHE
+    if CACHE is None:
+        update_cache()
     return CACHE
 
 def update_cache():
@@ -58,176 +95,244 @@ def update_cache():
     Returns:
         The new apt.cache.Cache object.
     """
+    from apt.cache import Cache
+
     global CACHE
     CACHE = Cache()
     return CACHE
 
-def remove_debs(remove_debs, window):
-    remove_thread = RemoveThread(remove_debs, window)
-    remove_thread.start()
+def remove_debs(remove_debs, window, refresh=False):
+    remover = Remover(remove_debs, window, refresh)
+    remover.start()
+    return remover
+
+def pipeline_removals(window, refresh=False):
+    """ Start removing Debian packages as they're queued.
+
+    Returns:
+        The PipelinedRemover to queue packages on.
+    """
+    remover = PipelinedRemover(window, refresh)
+    remover.start()
+    return remover
+
+class Remover:
+    """ Removes Debian packages using the privileged service.
+
+    The removal is a single asynchronous D-Bus call. Its progress signals and
+    reply are handled on the main loop as they arrive, so we don't need a 
+    thread or any polling.
 
-class RemoveThread(Thread):
-    def __init__(self, packages, window):
-        super().__init__()
+    Packages are removed using the local package lists. If refresh is True, the
+    lists are downloaded again first, as a separate step.
+    """
+
+    def __init__(self, packages, window, refresh=False):
         self.log = getLogger('pop-transition.apt')
         self.window = window
         self.packages = packages
+        self.refresh:bool = refresh
         self.success:list = []
-        self.cache_open:bool = False
+        self.debs:list = []
+        self.attempts:int = 0
+        self.proxy = None
+        self.signal_id = None
     
-    def run(self):
-        pkg_list = []
-
+    def start(self):
+        """ Start removing the packages."""
         for package in self.packages:
-            pkg_list.append(package.deb_package)
-            idle_add(package.set_status_text, 'Waiting')
-
-        self.log.info(f'Removing debs: {pkg_list}')
-
-        # Keep trying to obtain a lock and remove the packages
-        count:int = 0
-        while True:
-            self.log.info('Waiting for package manager lock')
-            idle_add(
-                self.packages[0].set_status_text,
-                'Waiting for the package system lock'
-            )
-            lock, error = self.lock_cache()
-            self.log.debug('Lock: %s; Error: %s', lock, error)
-            if lock:
-                break
-            if count >= 2: # Insist on password entry 3 times, then error out
-                self.log.error('Could not open package cache: Permission Denied')
-                idle_add(
-                    self.window.show_error,
-                    'Packages could not be removed',
-                    error,
-                    None
-                )
-                self.cache_open = False
-                idle_add(self.window.show_summary_page)
+            self.debs.append(package.deb_package)
+            package.set_status_text('Waiting')
+
+        self.log.info(f'Removing debs: {self.debs}')
+
+        # The service handles locking, removal and releasing the lock in a 
+        # single call, and reports what it's doing with signals. Debugging 
+        # information can be obtained by running the dbus service from a root 
+        # terminal and observing the output.
+        self.proxy = get_privileged_object()
+        self.signal_id = self.proxy.connect('g-signal', self.on_signal)
+        if self.refresh:
+            self.refresh_cache()
+        else:
+            self.remove()
+    
+    def refresh_cache(self):
+        """ Ask the service to refresh the package lists."""
+        self.attempts += 1
+        self.proxy.call(
+            'refresh_cache',
+            None,
+            Gio.DBusCallFlags.NONE,
+            TRANSACTION_TIMEOUT * 1000,
+            None,
+            self.on_refreshed,
+            None
+        )
+    
+    def on_refreshed(self, proxy, result, data=None):
+        """ Remove the packages once the lists are refreshed.
+
+        If they couldn't be refreshed, we can still remove the packages using
+        the local lists.
+        """
+        try:
+            proxy.call_finish(result)
+        except GLib.Error as err:
+            denied = 'org.pop_os.transition_system.PermissionDeniedByPolicy'
+            if denied in err.message and self.attempts < 3:
+                self.refresh_cache()
                 return
-            if error:
-                count += 1
-                time.sleep(.5)
-                continue
-            self.log.warning('Could not obtain lock, trying again in 5 seconds')
-            time.sleep(5)
-        
-        # Most of the following code is contained within try-except blocks 
-        # because we need to be 100% sure that we release the package manager
-        # lock at the end of the process, so we cannot allow a failure from the
-        # package system to propagate outwards and prevent release of the lock.
-        # debugging information can be obtained by running the dbus service from 
-        # a root terminal and observing the output. 
-        self.open_cache()
-
-        if self.cache_open:
-            self.mark()
+            self.log.warning(
+                'Could not refresh package lists, using local lists: %s',
+                err.message
+            )
         
-        if self.cache_open and self.success:
-            self.commit()
+        self.remove()
+    
+    def remove(self):
+        """ Start removing the packages, once the lists are ready."""
+        self.attempts = 0
+        self.call()
+    
+    def call(self):
+        """ Ask the service to remove the packages."""
+        self.attempts += 1
+        self.proxy.call(
+            'remove_transaction',
+            GLib.Variant('(as)', (self.debs,)),
+            Gio.DBusCallFlags.NONE,
+            TRANSACTION_TIMEOUT * 1000,
+            None,
+            self.on_finished,
+            None
+        )
+    
+    def on_signal(self, proxy, sender_name, signal_name, parameters):
+        """ Show the progress reported by the privileged service."""
+        if signal_name != 'transaction_progress':
+            return
+
+        stage, message = parameters.unpack()
+        self.log.info('%s: %s', stage, message)
+        if stage == 'marking':
+            for package in self.packages:
+                if package.deb_package == message:
+                    dispatch.update(
+                        package.set_status_text, f'Removing {message}'
+                    )
+        elif self.packages:
+            # dpkg reports progress far faster than it's worth redrawing.
+            # A PipelinedRemover has no current batch while it refreshes the
+            # lists, so that progress is only logged.
+            dispatch.update(self.packages[0].set_status_text, message)
+    
+    def on_finished(self, proxy, result, data=None):
+        """ Handle the reply from the service."""
+        removed = []
+        try:
+            removed = proxy.call_finish(result).unpack()[0]
         
-        if self.cache_open:
-            self.close()
+        except GLib.Error as err:
+            denied = 'org.pop_os.transition_system.PermissionDeniedByPolicy'
+            if denied in err.message and self.attempts < 3:
+                # Insist on password entry 3 times, then error out
+                self.call()
+                return
+            
+            self.log.error('Could not remove packages: %s', err.message)
+            self.window.show_error(
+                'Packages could not be removed',
+                err,
+                None
+            )
 
-        # Don't exit until the lock is released.
-        self.release()
+        for name in removed:
+            if name:
+                self.log.info(f'Removed {name}.')
+                self.success.append(name)
                 
-        # idle_add(self.window.quit_app)
         for package in self.packages:
             if package.deb_package in self.success:
-                idle_add(package.set_removed, True)
+                package.set_removed(True)
         
-        idle_add(self.window.show_summary_page)
+        self.window.app.finish_migration(self.packages)
+        self.finish()
     
-    def lock_cache(self) -> tuple:
-        err = None
-        lock = False
-        try:
-            lock:bool = privileged_object.obtain_lock()
-        except dbus.exceptions.DBusException as e:
-            if 'org.pop_os.transition_system.PermissionDeniedByPolicy' in str(e):
-                err = e
-        except Exception as e:
-            pass
+    def finish(self):
+        """ Show the results once all of the packages have been handled."""
+        self.proxy.disconnect(self.signal_id)
+        self.window.app.refresh_packages()
+        self.window.show_summary_page()
 
-        return (lock, err)
+class PipelinedRemover(Remover):
+    """ Removes Debian packages as their Flatpaks finish installing.
 
+    Packages are queued with add() while other Flatpaks are still downloading.
+    Everything queued is removed in one transaction, and anything queued while
+    that runs goes into the next one. This way the removals overlap with the
+    remaining downloads instead of waiting for all of them.
 
-    def open_cache(self):
-        try:
-            self.log.info('Opening cache')
-            privileged_object.open_cache()
-            self.cache_open = True
-        except Exception as exc:
-            self.log.error('Could not open package cache: %s', exc)
-            idle_add(
-                self.window.show_error,
-                'Packages could not be removed',
-                exc,
-                None
-            )
-            self.cache_open = False
-    
-    def mark(self):
-        try:
-            for package in self.packages:
-                self.log.info(f'Removing {package.deb_package}')
-                idle_add(package.set_status_text, f'Removing {package.deb_package}')
-                removed = privileged_object.remove_package(package.deb_package)
-                if removed:
-                    self.log.info(f'Marked {removed} removed.')
-                    self.success.append(removed)
-        except Exception as e:
-            self.log.error('Could not mark packages for removal: %s', e)
-            idle_add(
-                self.window.show_error,
-                'Packages could not be removed',
-                e,
-                None
-            )
-            self.success = []
+    Once close() has been called and the queue is empty, the results are shown.
+    """
+
+    def __init__(self, window, refresh=False):
+        super().__init__([], window, refresh)
+        self.queue:list = []
+        self.busy:bool = False
+        self.closed:bool = False
     
-    def commit(self):
-        self.log.info('Committing changes to the package system')
-        try:
-            privileged_object.commit_changes()
-        except Exception as e:
-            self.log.error('Could not commit changes!')
-            idle_add(
-                self.window.show_error,
-                'Packages could not be removed',
-                e,
-                None
-            )
-            self.success = []
+    def start(self):
+        """ Connect to the service.
 
+        The lists aren't refreshed until the first batch is ready, because the
+        service keeps the package system locked from the refresh until the
+        removal, and the Flatpaks may take a long time to download.
+        """
+        self.proxy = get_privileged_object()
+        self.signal_id = self.proxy.connect('g-signal', self.on_signal)
+    
+    def add(self, package):
+        """ Queue the Debian package of an app for removal."""
+        package.set_status_text('Waiting')
+        self.queue.append(package)
+        self.next_batch()
+    
     def close(self):
-        try:
-            privileged_object.close_cache()
-            self.cache_open = False
-        except Exception as e:
-            self.log.error('Could not close the package cache')
-            idle_add(
-                self.window.show_error,
-                'Package system error',
-                e,
-                None
-            )
+        """ Note that no more packages will be queued."""
+        self.closed = True
+        self.next_batch()
+    
+    def next_batch(self):
+        """ Remove the queued packages, unless a transaction is running."""
+        if self.busy:
+            return
+
+        if not self.queue:
+            if self.closed:
+                super().finish()
+            return
 
-    def release(self):
-        while True:
-            try:
-                self.log.info('Releasing package manager lock')
-                idle_add(
-                    self.packages[0].set_status_text,
-                    'Releasing Package Manager Lock'
-                )
-                unlock = privileged_object.release_lock()
-                if unlock:
-                    break
-            except Exception as e:
-                self.log.warning(e)
-                continue
+        if self.refresh:
+            # remove() starts on the queue once the lists are refreshed.
+            self.refresh = False
+            self.busy = True
+            self.refresh_cache()
+            return
 
+        self.packages = self.queue
+        self.queue = []
+        self.debs = [package.deb_package for package in self.packages]
+        self.log.info(f'Removing debs: {self.debs}')
+        self.busy = True
+        self.attempts = 0
+        self.call()
+    
+    def remove(self):
+        # Once the lists are refreshed, start on whatever has been queued.
+        self.busy = False
+        self.next_batch()
+    
+    def finish(self):
+        self.busy = False
+        self.next_batch()
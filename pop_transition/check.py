@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2020 Ian Santopietro
+Copyright (c) 2020 System76, Inc.
+All rights reserved.
+
+This file is part of Pop-Transition.
+
+    Pop-Transition is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pop-Transition is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pop-Transition.  If not, see <https://www.gnu.org/licenses/>.
+
+pop-transition - Command-line check for deprecated packages.
+
+This is kept separate from the application so that it can run without loading
+Gtk, Flatpak or D-Bus. Only the detection modules are imported here.
+"""
+
+import json
+
+from . import detect
+from .apps import APPS
+from .package import get_installed_packages
+
+def run_check(json_output=False, backend=None):
+    """ Checks for installed Debian packages which should be transitioned.
+
+    Arguments:
+        json_output (bool): Produce machine-readable JSON instead of text.
+        backend (str): The detection backend to use, one of detect.BACKENDS.
+
+    Returns:
+        A tuple of whether any deprecated packages are installed, and the text
+        to output.
+    """
+    backend = detect.CachedBackend(detect.get_backend(backend), APPS)
+    installed_pkgs = list(get_installed_packages(APPS, backend))
+    output = bool(installed_pkgs)
+
+    if json_output:
+        packages = []
+        for package in installed_pkgs:
+            packages.append({
+                'name': package.name,
+                'deb_package': package.deb_package,
+                'installed_version': package.detection.installed_version,
+                'upgrade_origin': package.upgrade_origin,
+                'app_id': package.app_id,
+            })
+        output_text = json.dumps(
+            {'deprecated': output, 'packages': packages}, indent=2
+        )
+        return (output, output_text)
+    
+    output_text = 'No installed Debian packages are depcrecated by Pop!_OS.'
+    if installed_pkgs:
+        output_text = (
+            'The following Debian packages have been deprecated by Pop!_OS. '
+            'Please install the corresponding Flatpaks and remove the deprecated '
+            'Debian packages:\n'
+        )
+        for package in installed_pkgs:
+            output_text += f'    {package.name}: {package.deb_package} is now {package.app_id}\n'
+    
+    return (output, output_text)
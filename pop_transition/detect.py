@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2020 Ian Santopietro
+Copyright (c) 2020 System76, Inc.
+All rights reserved.
+
+This file is part of Pop-Transition.
+
+    Pop-Transition is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pop-Transition is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pop-Transition.  If not, see <https://www.gnu.org/licenses/>.
+
+pop-transition - Installed package detection.
+"""
+
+import hashlib
+import json
+import os
+import re
+from logging import getLogger
+from pathlib import Path
+from typing import NamedTuple
+
+from . import dismissal
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_LISTS = '/var/lib/apt/lists'
+
+# Packages which would be upgraded from one of these origins are no longer
+# receiving updates. An empty origin means there's no repository for it at all.
+TRANSITION_ORIGINS = ('', 'system76', 'LP-PPA-system76-pop')
+
+DEFAULT_BACKEND = 'dpkg'
+
+# Bump this whenever the format of stored detection results changes.
+CACHE_FORMAT = 2
+
+log = getLogger('pop-transition.detect')
+
+class Detection(NamedTuple):
+    """ The detected state of a Debian package."""
+    installed: bool = False
+    installed_version: str = None
+    candidate_version: str = None
+    origins: tuple = ()
+
+    @property
+    def upgrade_origin(self):
+        """ str: the origin that will be used if the package is upgraded"""
+        if self.origins:
+            return self.origins[0]
+        return None
+
+    @property
+    def deprecated(self):
+        """ bool: whether the package is installed and no longer updated."""
+        return self.installed and self.upgrade_origin in TRANSITION_ORIGINS
+
+def read_dpkg_status(names, status_path=DPKG_STATUS):
+    """ Finds which of a set of packages are installed.
+
+    Only the stanzas for the requested packages are parsed out of the dpkg
+    status file, so this is fast even on systems with many packages.
+
+    Arguments:
+        names ([str]): The names of the packages to look up.
+        status_path (str): The path to the dpkg status file.
+
+    Returns:
+        A dict mapping the name of each installed package to its version.
+    """
+    with open(status_path, 'rb') as status_file:
+        status = status_file.read()
+
+    pattern = re.compile(
+        rb'^Package: ('
+        + b'|'.join(re.escape(name.encode()) for name in names)
+        + rb')\n',
+        re.MULTILINE
+    )
+
+    installed = {}
+    for match in pattern.finditer(status):
+        end = status.find(b'\n\n', match.end())
+        if end < 0:
+            end = len(status)
+
+        fields = {}
+        for line in status[match.end():end].split(b'\n'):
+            # Skip continuation lines of multi-line fields
+            if line[:1].isspace() or b':' not in line:
+                continue
+            key, value = line.split(b':', 1)
+            fields[key] = value.strip()
+
+        # The third word of the Status field is the current package state
+        state = fields.get(b'Status', b'').split()
+        if len(state) == 3 and state[2] == b'installed':
+            name = match.group(1).decode()
+            installed[name] = fields.get(b'Version', b'').decode()
+
+    return installed
+
+def get_candidates(names):
+    """ Finds the version each package would be upgraded to, and its origins.
+
+    This uses the low-level apt_pkg cache directly, so we don't pay for
+    building Python objects for every package on the system.
+
+    Arguments:
+        names ([str]): The names of the packages to look up.
+
+    Returns:
+        A dict mapping each name to a (candidate_version, origins) tuple. The
+        version is None if the package has no candidate.
+    """
+    import apt_pkg
+
+    apt_pkg.init()
+    cache = apt_pkg.Cache(None)
+    depcache = apt_pkg.DepCache(cache)
+
+    candidates = {}
+    for name in names:
+        candidates[name] = (None, ())
+        try:
+            candidate = depcache.get_candidate_ver(cache[name])
+        except KeyError:
+            continue
+        if candidate:
+            origins = tuple(
+                package_file.origin or ''
+                for package_file, _index in candidate.file_list
+            )
+            candidates[name] = (candidate.ver_str, origins)
+    return candidates
+
+class DpkgBackend:
+    """ Detects packages using the dpkg status file.
+
+    The apt package cache is only consulted when one of the packages is
+    actually installed, to find where it would be upgraded from.
+    """
+
+    def __init__(self, status_path=DPKG_STATUS):
+        self.status_path = status_path
+
+    def query(self, names):
+        """ Looks up the state of a set of packages.
+
+        Arguments:
+            names ([str]): The names of the packages to look up.
+
+        Returns:
+            A dict mapping each name to its Detection.
+        """
+        installed = read_dpkg_status(names, self.status_path)
+        log.debug('Installed packages: %s', installed)
+
+        candidates = {}
+        if installed:
+            candidates = get_candidates(installed)
+
+        results = {}
+        for name in names:
+            if name not in installed:
+                results[name] = Detection()
+                continue
+            candidate_version, origins = candidates[name]
+            results[name] = Detection(
+                True, installed[name], candidate_version, origins
+            )
+        return results
+
+    def refresh(self):
+        """ Nothing to do, since every query reads the current state."""
+
+class AptBackend:
+    """ Detects packages using a full apt.cache.Cache."""
+
+    def query(self, names):
+        """ Looks up the state of a set of packages.
+
+        Arguments:
+            names ([str]): The names of the packages to look up.
+
+        Returns:
+            A dict mapping each name to its Detection.
+        """
+        from . import apt
+        cache = apt.get_cache()
+
+        results = {}
+        for name in names:
+            try:
+                pkg = cache[name]
+            except KeyError:
+                results[name] = Detection()
+                continue
+
+            installed_version = None
+            if pkg.installed:
+                installed_version = pkg.installed.version
+
+            candidate_version = None
+            origins = ()
+            if pkg.candidate:
+                candidate_version = pkg.candidate.version
+                origins = tuple(
+                    origin.origin or '' for origin in pkg.candidate.origins
+                )
+
+            results[name] = Detection(
+                pkg.is_installed, installed_version, candidate_version, origins
+            )
+        return results
+
+    def refresh(self):
+        """ Replaces the apt cache, so later queries see the current state."""
+        from . import apt
+        apt.update_cache()
+
+def get_state_key(app_list, backend_name, status_path=DPKG_STATUS,
+                  lists_path=APT_LISTS):
+    """ Gets a key which changes whenever detection results could change.
+
+    The key covers the app definitions, the backend used, and the size and
+    modification time of the dpkg status file and each apt package list.
+
+    Returns:
+        The key, as a str.
+    """
+    digest = hashlib.sha256()
+    digest.update(str(CACHE_FORMAT).encode())
+    digest.update(json.dumps(app_list, sort_keys=True).encode())
+    digest.update(backend_name.encode())
+
+    paths = [Path(status_path)]
+    try:
+        paths += sorted(Path(lists_path).iterdir())
+    except OSError:
+        pass
+
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        digest.update(f'{path} {stat.st_mtime_ns} {stat.st_size}\n'.encode())
+
+    return digest.hexdigest()
+
+class CachedBackend:
+    """ Wraps another backend, storing its results on disk.
+
+    Results are reused until the package state or the app definitions change,
+    so the login-time check doesn't need to detect anything most of the time.
+    """
+
+    def __init__(self, backend, app_list, cache_path=None):
+        self.backend = backend
+        self.app_list = app_list
+        self._cache_path = cache_path
+
+    @property
+    def cache_path(self):
+        """ Path: The cache file.
+
+        The default location is only looked up when it's first needed, since
+        that creates the data directory in the user's home.
+
+        Raises:
+            OSError: if the home directory is missing or can't be written to.
+        """
+        if self._cache_path is None:
+            self._cache_path = (
+                dismissal.get_transition_path() / 'detection-cache.json'
+            )
+        return Path(self._cache_path)
+
+    def load(self, key):
+        """ Returns the stored results if they match key, else None."""
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if cached.get('key') != key:
+            return None
+        results = {}
+        for name, state in cached['results'].items():
+            installed, installed_version, candidate_version, origins = state
+            results[name] = Detection(
+                installed, installed_version, candidate_version, tuple(origins)
+            )
+        return results
+
+    def store(self, key, results):
+        """ Saves results to the cache file."""
+        try:
+            temp_path = self.cache_path.with_suffix('.tmp')
+            with open(temp_path, 'w') as cache_file:
+                json.dump({'key': key, 'results': results}, cache_file)
+            os.replace(temp_path, self.cache_path)
+        except OSError as err:
+            log.warning('Could not save detection results: %s', err)
+
+    def query(self, names):
+        """ Looks up the state of a set of packages.
+
+        Arguments:
+            names ([str]): The names of the packages to look up.
+
+        Returns:
+            A dict mapping each name to its Detection.
+        """
+        key = get_state_key(self.app_list, type(self.backend).__name__)
+        results = self.load(key)
+        if results is not None and all(name in results for name in names):
+            log.debug('Using cached detection results')
+            return results
+
+        results = self.backend.query(names)
+        self.store(key, results)
+        return results
+
+    def refresh(self):
+        """ Refreshes the wrapped backend.
+
+        Stored results are keyed on the package state, so they don't need to
+        be cleared here.
+        """
+        self.backend.refresh()
+
+BACKENDS = {
+    'apt': AptBackend,
+    'dpkg': DpkgBackend,
+}
+
+def get_backend(name=None):
+    """ Gets a detection backend.
+
+    Arguments:
+        name (str): The backend to use, one of BACKENDS. Defaults to
+            DEFAULT_BACKEND.
+
+    Returns:
+        An instance of the backend.
+    """
+    if name is None:
+        name = DEFAULT_BACKEND
+    return BACKENDS[name]()
+
+def detect_packages(packages, backend):
+    """ Detects the state of a batch of packages.
+
+    The result is stored on each package, so that reading it later doesn't
+    touch the package system again.
+
+    Arguments:
+        packages ([Package]): The packages to detect.
+        backend: The detection backend to use.
+    """
+    results = backend.query([package.deb_package for package in packages])
+    for package in packages:
+        package.detection = results[package.deb_package]
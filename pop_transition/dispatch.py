@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2020 Ian Santopietro
+Copyright (c) 2020 System76, Inc.
+All rights reserved.
+
+This file is part of Pop-Transition.
+
+    Pop-Transition is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pop-Transition is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pop-Transition.  If not, see <https://www.gnu.org/licenses/>.
+
+pop-transition - Throttled UI updates from worker threads.
+"""
+
+import itertools
+from collections import OrderedDict
+from threading import Lock
+
+from gi.repository import GLib
+
+# How often queued updates are applied, in milliseconds (about 30 per second).
+FRAME_INTERVAL = 33
+
+class Dispatcher:
+    """ Passes UI changes from worker threads to the main loop.
+
+    Instead of an idle callback for every change, changes are queued and
+    applied together at a fixed frame rate. A queued update replaces any
+    pending update made with the same method of the same object, so only the
+    latest status or progress is drawn, however often it changes.
+    """
+
+    def __init__(self, interval=FRAME_INTERVAL):
+        self.interval = interval
+        self.lock = Lock()
+        self.pending = OrderedDict()
+        self.counter = itertools.count()
+        self.source_id = None
+
+    def update(self, func, *args):
+        """ Queue a change, replacing any pending change made with func.
+
+        Arguments:
+            func: A bound method, e.g. package.set_status_text.
+            args: The arguments to call it with.
+        """
+        key = (getattr(func, '__self__', None), getattr(func, '__func__', func))
+        with self.lock:
+            # Move it to the end, so it stays in order with other calls.
+            self.pending.pop(key, None)
+            self.pending[key] = (func, args)
+            self._schedule()
+
+    def call(self, func, *args):
+        """ Queue a call which always runs, in order with other changes.
+
+        Use this for actions (e.g. showing a page or an error) rather than
+        states.
+        """
+        with self.lock:
+            self.pending[next(self.counter)] = (func, args)
+            self._schedule()
+
+    def _schedule(self):
+        if self.source_id is None:
+            self.source_id = GLib.timeout_add(self.interval, self.flush)
+
+    def flush(self):
+        """ Apply all of the queued changes, on the main loop."""
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.source_id = None
+
+        for func, args in pending:
+            func(*args)
+        return False
+
+DISPATCHER = Dispatcher()
+
+def update(func, *args):
+    """ Queue a coalesced UI change on the shared Dispatcher."""
+    DISPATCHER.update(func, *args)
+
+def call(func, *args):
+    """ Queue a UI action on the shared Dispatcher."""
+    DISPATCHER.call(func, *args)
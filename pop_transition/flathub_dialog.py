@@ -26,7 +26,7 @@ from threading import Thread
 
 import gettext
 from gi.repository import Flatpak, Gio, GLib, Gtk, Pango
-from . import flatpak
+from . import dispatch, flatpak
 
 _ = gettext.gettext
 FLATPAKREPO_URL = 'https://flathub.org/repo/flathub.flatpakrepo'
@@ -184,5 +184,5 @@ class AddThread(Thread):
         except GLib.Error as e:
             contents = None
         
-        GLib.idle_add(self.dialog.spinner.stop)
-        GLib.idle_add(self.dialog.set_sensitive, True)
+        dispatch.call(self.dialog.spinner.stop)
+        dispatch.call(self.dialog.set_sensitive, True)
@@ -24,13 +24,51 @@ pop-transition - flatpak interface module.
 """
 
 import subprocess
+import time
 from logging import getLogger
+from pathlib import Path
 
 from threading import Thread
 from gi.repository import Flatpak, GLib
-from gi.repository.GLib import idle_add
 from repoman import flatpak_helper
 
+from . import dismissal, dispatch
+
+# When to run a full `flatpak repair --user` before installing:
+REPAIR_AUTO = 'auto'      # Only if a check fails or the last install failed
+REPAIR_ALWAYS = 'always'
+REPAIR_NEVER = 'never'
+
+# Appstream data newer than this many seconds isn't downloaded again.
+APPSTREAM_MAX_AGE = 6 * 60 * 60
+
+# How often to update the progress of a download, in milliseconds.
+PROGRESS_INTERVAL = 250
+
+def get_repair_marker():
+    """ Gets the file marking that the last Flatpak transaction failed.
+
+    Returns:
+        The Path() for the marker file
+    """
+    return dismissal.get_transition_path() / 'flatpak-repair-needed'
+
+def get_runtime(remote_ref):
+    """ Gets the runtime an app uses, from its metadata in the remote summary.
+
+    Returns:
+        The runtime as name/arch/branch, or None if it isn't known.
+    """
+    metadata = remote_ref.get_metadata()
+    if metadata is None:
+        return None
+    keyfile = GLib.KeyFile()
+    try:
+        keyfile.load_from_bytes(metadata, GLib.KeyFileFlags.NONE)
+        return keyfile.get_string('Application', 'runtime')
+    except GLib.Error:
+        return None
+
 def get_flathub_remote():
     """ Finds the Flathub remote and returns it.
 
@@ -53,63 +91,126 @@ def get_user_installation():
     """
     return flatpak_helper.get_installation_for_type('user')
 
-def install_flatpaks(packages, window):
+def get_appstream_age(remote):
+    """ Gets how long ago the appstream data for a remote was updated.
+
+    Returns:
+        The age in seconds, or None if there's no local appstream data.
+    """
+    timestamp = remote.get_appstream_timestamp(Flatpak.get_default_arch())
+    path = timestamp.get_path() if timestamp else None
+    if not path:
+        return None
+    
+    try:
+        return time.time() - Path(path).stat().st_mtime
+    except OSError:
+        return None
+
+def install_flatpaks(packages, window, repair=REPAIR_AUTO,
+                     appstream_max_age=APPSTREAM_MAX_AGE, remover=None):
     """ Install a package from Flathub in user mode.
 
     Arguments:
         packages ([Package]): the package widgets to install.
+        repair (str): When to repair the installation first, one of REPAIR_AUTO,
+            REPAIR_ALWAYS or REPAIR_NEVER.
+        appstream_max_age (int): Refresh the appstream data if it's older than
+            this many seconds. Use 0 to always refresh it.
+        remover (apt.PipelinedRemover): If given, each app's Debian package
+            is queued on it for removal as soon as its Flatpak is installed,
+            instead of showing the Apt page at the end.
     """
-    install_thread = InstallThread(packages, window)
+    install_thread = InstallThread(
+        packages, window, repair, appstream_max_age, remover
+    )
     install_thread.start()
 
 class InstallThread(Thread):
 
-    def __init__(self, packages, window):
+    def __init__(self, packages, window, repair=REPAIR_AUTO,
+                 appstream_max_age=APPSTREAM_MAX_AGE, remover=None):
         super().__init__()
         self.log = getLogger('pop-transition.flatpak')
         self.packages = packages
         self.window = window
+        self.repair = repair
+        self.appstream_max_age = appstream_max_age
+        self.remover = remover
+        self.failed:bool = False
+
+        # Lookups from transaction operations to the packages they belong to.
+        # Refs of the apps themselves are added as they're added to the 
+        # transaction; runtimes and extensions are attributed to the app which 
+        # pulled them in once the transaction is ready.
+        self.packages_by_id = {package.app_id: package for package in packages}
+        self.packages_by_ref = {}
+        self.related_by_ref = {}
+
+        # When we last showed progress for each operation, and the last 10%
+        # mark we logged.
+        self.progress_shown = {}
+        self.progress_logged = {}
         self.user = get_user_installation()
         self.flathub = get_flathub_remote()
     
     def run(self):
-        idle_add(self.packages[0].set_status_text, 'Updating Appstream Data')
-        self.log.info("Repairing Flatpak installation")
-        # Sometimes this appears to cause issues, so we need to do a quick 
-        # repair first to ensure that the local installation is consistent.
+        dispatch.update(
+            self.packages[0].set_status_text, 'Updating Appstream Data'
+        )
+        remote_refs = self.resolve_refs()
+
+        # An inconsistent local installation can cause installs to fail, so
+        # repair it first if needed.
         # See https://github.com/flatpak/flatpak/issues/4095
         try:
-            subprocess.run(['flatpak', 'repair', '--user'])
+            if self.needs_repair(remote_refs):
+                start = time.perf_counter()
+                self.log.info("Repairing Flatpak installation")
+                subprocess.run(['flatpak', 'repair', '--user'])
+                self.log.info(
+                    'Full repair took %.2fs', time.perf_counter() - start
+                )
         except Exception as err:
-            idle_add(self.window.show_summary_page)
-            idle_add(
+            dispatch.call(self.window.show_summary_page)
+            dispatch.call(
                 self.window.show_error,
                 'Could not verify Flatpak installation',
                 err,
                 None
             )
+            self.close_remover()
             return
 
-        self.log.info('Updating Appstream Data')
         # If the appstream data is out of date, it can cause problems installing
-        # some applications. So we update it first.
+        # some applications. So we update it first, unless something else 
+        # (e.g. Pop!_Shop) has done so recently.
         try:
-            self.user.update_appstream_full_sync(self.flathub.get_name())
+            age = get_appstream_age(self.flathub)
+            if age is None or age >= self.appstream_max_age:
+                self.log.info('Updating Appstream Data')
+                self.user.update_appstream_full_sync(self.flathub.get_name())
+            else:
+                self.log.info(
+                    'Appstream data is %d minutes old, not updating', age // 60
+                )
         except Exception as err:
-            idle_add(self.window.show_summary_page)
-            idle_add(
+            dispatch.call(self.window.show_summary_page)
+            dispatch.call(
                 self.window.show_error,
                 'Could not update Appstream Information',
                 err,
                 None
             )
+            self.close_remover()
             return
 
         self.log.info('Installing Flatpaks...')
-        idle_add(self.packages[0].set_status_text, 'Waiting')
+        dispatch.update(self.packages[0].set_status_text, 'Waiting')
         
         # We use a transaction to get error details and to install dependencies 
         transaction = Flatpak.Transaction.new_for_installation(self.user)
+        transaction.connect('ready', self.on_ready)
         transaction.connect('new_operation', self.on_new_operation)
         transaction.connect('operation-done', self.on_operation_done)
         transaction.connect('operation-error', self.on_operation_error)
@@ -117,87 +218,332 @@ class InstallThread(Thread):
         for package in self.packages:
             self.log.debug(f'Installing {package.name} flatpak {package.app_id}.')
             try:
-                remote_ref = self.user.fetch_remote_ref_sync(
-                    self.flathub.get_name(),
-                    Flatpak.RefKind.APP,
-                    package.app_id,
-                    None,
-                    'stable'
-                )
+                remote_ref = remote_refs.get(package.app_id)
+                if not remote_ref:
+                    remote_ref = self.user.fetch_remote_ref_sync(
+                        self.flathub.get_name(),
+                        Flatpak.RefKind.APP,
+                        package.app_id,
+                        None,
+                        'stable'
+                    )
             except Exception as err:
                 self.log.error('Could not install flatpak: %s', err)
-                idle_add(
+                dispatch.call(
                     self.window.show_error,
                     'Packages could not be installed',
                     err,
                     package
                 )
-                idle_add(self.window.show_summary_page)
+                dispatch.call(self.window.show_summary_page)
+                continue
             try:
-                transaction.add_install(
-                    self.flathub.get_name(), remote_ref.format_ref()
-                )
-                idle_add(package.set_status_text, 'Waiting')
+                ref = remote_ref.format_ref()
+                transaction.add_install(self.flathub.get_name(), ref)
+                self.packages_by_ref[ref] = package
+                dispatch.update(package.set_status_text, 'Waiting')
             except GLib.Error as err:
-                idle_add(package.stop_spinner)
+                dispatch.update(package.stop_spinner)
                 
                 # Package is already installed, inform the user
                 if 'is already installed' in err.message:
-                    idle_add(package.set_status_text, 'Already Installed')
-                    idle_add(package.set_installed_status, 'already installed')
+                    dispatch.update(package.set_status_text, 'Already Installed')
+                    dispatch.update(
+                        package.set_installed_status, 'already installed'
+                    )
+                    self.queue_removal(package)
                 
                 # Or there was some other error, let the user know
                 else:
-                    idle_add(package.set_status_text, 'Error installing')
-                    idle_add(package.set_installed_status, err.message)
+                    dispatch.update(package.set_status_text, 'Error installing')
+                    dispatch.update(package.set_installed_status, err.message)
         
         try:
             transaction.run()
         except Exception as err:
+            self.failed = True
             self.log.error('Could not install flatpak: %s', err)
-            idle_add(
+            dispatch.call(
                 self.window.show_error,
                 'Packages could not be installed',
                 err,
                 package
             )
-            idle_add(self.window.show_summary_page)
+            dispatch.call(self.window.show_summary_page)
+
+        self.update_repair_marker()
 
-        idle_add(self.window.show_apt_page)
+        if self.remover:
+            self.close_remover()
+        else:
+            dispatch.call(self.window.show_apt_page)
+    
+    def update_repair_marker(self):
+        """ Make sure the installation is repaired before trying again, if the
+        transaction failed.
+        """
+        try:
+            if self.failed:
+                get_repair_marker().touch()
+            else:
+                get_repair_marker().unlink(missing_ok=True)
+        except OSError as err:
+            self.log.warning('Could not update the repair marker: %s', err)
     
+    def queue_removal(self, package):
+        """ Queue the Debian package for removal, if we're pipelining."""
+        if self.remover:
+            dispatch.call(self.remover.add, package)
+    
+    def close_remover(self):
+        """ Let the remover finish once its queue is empty."""
+        if self.remover:
+            dispatch.call(self.remover.close)
+    
+    def needs_repair(self, remote_refs):
+        """ Decide whether to run a full repair of the user installation.
+
+        Instead of verifying every object in the repository, only the installed
+        runtimes (and their extensions) which the apps will use are checked:
+        each must be deployed, and the commit it was deployed from must still
+        be in the repository. Damage inside a deployment isn't found this way;
+        use REPAIR_ALWAYS for that. A full repair is also done if the last
+        transaction failed.
+
+        Arguments:
+            remote_refs (dict): The remote refs of the apps, from resolve_refs.
+
+        Returns:
+            True if `flatpak repair --user` should be run.
+        """
+        if self.repair != REPAIR_AUTO:
+            return self.repair == REPAIR_ALWAYS
+        
+        if get_repair_marker().exists():
+            self.log.info('The last Flatpak transaction failed, repairing')
+            return True
+
+        start = time.perf_counter()
+        repo = Path(self.user.get_path().get_path()) / 'repo'
+        runtimes = {get_runtime(ref) for ref in remote_refs.values()}
+        runtimes.discard(None)
+        consistent = True
+        for runtime in runtimes:
+            name, arch, branch = runtime.split('/')
+            try:
+                installed_ref = self.user.get_installed_ref(
+                    Flatpak.RefKind.RUNTIME, name, arch, branch, None
+                )
+            except GLib.Error:
+                # Not installed, so the transaction will pull all of it.
+                continue
+            
+            installed_refs = [installed_ref]
+            try:
+                related_refs = self.user.list_installed_related_refs_sync(
+                    self.flathub.get_name(), f'runtime/{runtime}', None
+                )
+            except GLib.Error:
+                related_refs = []
+            for related in related_refs:
+                try:
+                    installed_refs.append(self.user.get_installed_ref(
+                        related.get_kind(),
+                        related.get_name(),
+                        related.get_arch(),
+                        related.get_branch(),
+                        None
+                    ))
+                except GLib.Error:
+                    continue
+            
+            for ref in installed_refs:
+                if not self.is_intact(ref, repo):
+                    self.log.warning(
+                        f'{ref.format_ref()} is damaged, repairing'
+                    )
+                    consistent = False
+                    break
+            if not consistent:
+                break
+        
+        self.log.info(
+            'Checking %d runtimes took %.3fs',
+            len(runtimes), time.perf_counter() - start
+        )
+        return not consistent
+
+    def is_intact(self, installed_ref, repo):
+        """ Check that an installed ref is deployed, and its commit is in repo.
+        """
+        deploy_dir = installed_ref.get_deploy_dir()
+        if not deploy_dir or not Path(deploy_dir).is_dir():
+            return False
+        
+        # OSTree stores objects as objects/<first 2 hex digits>/<the rest>
+        commit = installed_ref.get_commit()
+        if not commit:
+            return False
+        return (repo / 'objects' / commit[:2] / f'{commit[2:]}.commit').exists()
+
+    def resolve_refs(self):
+        """ Look up the remote refs for all of the packages at once.
+
+        This uses a single listing of the remote's refs (which Flatpak caches),
+        rather than a separate metadata lookup for every app.
+
+        Returns:
+            A dict mapping app IDs to their stable Flatpak.RemoteRef for this 
+            arch. Apps which weren't found are left out.
+        """
+        app_ids = [package.app_id for package in self.packages]
+        arch = Flatpak.get_default_arch()
+        refs = {}
+
+        try:
+            remote_refs = self.user.list_remote_refs_sync(
+                self.flathub.get_name(), None
+            )
+        except GLib.Error as err:
+            self.log.warning('Could not list remote refs: %s', err.message)
+            return refs
+        
+        for ref in remote_refs:
+            if (
+                ref.get_kind() == Flatpak.RefKind.APP
+                and ref.get_name() in app_ids
+                and ref.get_arch() == arch
+                and ref.get_branch() == 'stable'
+            ):
+                refs[ref.get_name()] = ref
+        
+        self.log.debug(f'Resolved refs for {list(refs)}')
+        return refs
+
     def get_package_from_operation(self, operation):
+        """ Find the package an app's own operation belongs to.
+
+        Returns:
+            The package, or None for runtimes, extensions and unknown apps.
+        """
         ref = operation.get_ref()
-        ref_name = ref.split('/')[1]
-        self.log.debug(f'Looking for ID from ref {ref}')
+        package = self.packages_by_ref.get(ref)
+        if package is None and ref.startswith('app/'):
+            # Refs are kind/id/arch/branch
+            package = self.packages_by_id.get(ref.split('/')[1])
+        return package
+    
+    def on_ready(self, transaction):
+        """ Work out which app each runtime and extension is installed for.
 
-        for package in self.packages:
-            if ref_name == package.app_id:
-                self.log.debug(f'Found ID {ref_name} in package {package.name}')
-                return package
+        All of the operations are known at this point, but none have run.
+        """
+        operations = transaction.get_operations()
+        
+        for operation in operations:
+            package = self.get_package_from_operation(operation)
+            metadata = operation.get_metadata()
+            if not package or not metadata:
+                continue
+            try:
+                runtime = metadata.get_string('Application', 'runtime')
+            except GLib.Error:
+                continue
+            self.related_by_ref.setdefault(f'runtime/{runtime}', package)
+        
+        # Extensions (e.g. locales and GL drivers) know which operations they
+        # relate to, with Flatpak 1.11.1 and newer.
+        for operation in operations:
+            ref = operation.get_ref()
+            if ref in self.packages_by_ref or ref in self.related_by_ref:
+                continue
+            if not hasattr(operation, 'get_related_to_ops'):
+                break
+            for related in operation.get_related_to_ops() or []:
+                related_ref = related.get_ref()
+                package = (
+                    self.get_package_from_operation(related)
+                    or self.related_by_ref.get(related_ref)
+                )
+                if package:
+                    self.related_by_ref[ref] = package
+                    break
+
+        for ref, package in self.related_by_ref.items():
+            self.log.debug(f'{ref} is needed by {package.name}')
+        return True
     
     def on_new_operation(self, transaction, operation, progress):
         package = self.get_package_from_operation(operation)
+        ref = operation.get_ref()
         
-        # Don't try and update UI if there is no pacakge (probably a runtime)
         if package:
-            idle_add(package.start_spinner)
-            idle_add(package.set_status_text, 'Installing')
+            dispatch.update(package.start_spinner)
+            dispatch.update(package.set_status_text, 'Installing')
+        
+        # Runtimes and extensions are shown on the app which needs them.
+        else:
+            package = self.related_by_ref.get(ref)
+            if not package:
+                return
+            # Refs are kind/id/arch/branch
+            name = ref.split('/')[1]
+            dispatch.update(package.start_spinner)
+            dispatch.update(package.set_status_text, f'Installing {name}')
+        
+        progress.set_update_frequency(PROGRESS_INTERVAL)
+        progress.connect('changed', self.on_progress_changed, ref, package)
+    
+    def on_progress_changed(self, progress, ref, package):
+        """ Show how much of an operation has been downloaded."""
+        now = GLib.get_monotonic_time()
+        if now - self.progress_shown.get(ref, 0) < PROGRESS_INTERVAL * 1000:
+            return
+        self.progress_shown[ref] = now
+
+        percent = progress.get_progress()
+        transferred = progress.get_bytes_transferred()
+        elapsed = (now - progress.get_start_time()) / 1000000
+        rate = transferred / elapsed if elapsed > 0 else 0
+
+        text = f'{percent}%'
+        if transferred:
+            text += (
+                f' — {GLib.format_size(transferred)} '
+                f'({GLib.format_size(int(rate))}/s)'
+            )
+        dispatch.update(package.set_progress, percent / 100, text)
+
+        mark = percent // 10 * 10
+        if mark > self.progress_logged.get(ref, -1):
+            self.progress_logged[ref] = mark
+            self.log.info(f'{ref}: {text}')
 
     def on_operation_done(self, transaction, operation, commit, result):
         package = self.get_package_from_operation(operation)
         
-        # Don't try and update UI if there is no pacakge (probably a runtime)
-        if package:
-            idle_add(package.stop_spinner)
-            idle_add(package.set_status_text, "Flatpak installed")
-            idle_add(package.set_installed_status, 'installed')
+        # Runtimes and extensions don't finish the app, so just log them.
+        if not package:
+            self.log.info(f'Installed {operation.get_ref()}')
+            return
+        
+        dispatch.update(package.stop_spinner)
+        dispatch.update(package.hide_progress)
+        dispatch.update(package.set_status_text, "Flatpak installed")
+        dispatch.update(package.set_installed_status, 'installed')
+        self.queue_removal(package)
     
     def on_operation_error(self, transaction, operation, error, details):
         package = self.get_package_from_operation(operation)
         error_text = f"Error: {error.message}"
+        self.failed = True
+        
+        # An error in a runtime or extension is an error for the app needing it
+        if not package:
+            package = self.related_by_ref.get(operation.get_ref())
         
-        # Don't try and update UI if there is no pacakge (probably a runtime)
         if package:
-            idle_add(package.stop_spinner)
-            idle_add(package.set_status_text, "Error installing")
-            idle_add(package.set_installed_status, error_text)
+            dispatch.update(package.stop_spinner)
+            dispatch.update(package.hide_progress)
+            dispatch.update(package.set_status_text, "Error installing")
+            dispatch.update(package.set_installed_status, error_text)
@@ -27,6 +27,8 @@ import gettext
 
 from gi.repository import Gtk
 
+from .package_row import PackageRow
+
 _ = gettext.gettext
 
 class List(Gtk.Box):
@@ -56,9 +58,16 @@ class List(Gtk.Box):
     def add_package(self, package):
         """ Adds an application object to the list.
 
+        The row widget for the package is created here.
+
         Arguments: 
-            package (package): The package to add.
+            package (package.Package): The package to add.
+        
+        Returns:
+            The PackageRow added to the list.
         """
-        self.listbox.add(package)
-        self.packages.append(package)
+        row = PackageRow(package)
+        self.listbox.add(row)
+        self.packages.append(row)
+        return row
     
\ No newline at end of file
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2020 Ian Santopietro
+Copyright (c) 2020 System76, Inc.
+All rights reserved.
+
+This file is part of Pop-Transition.
+
+    Pop-Transition is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pop-Transition is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pop-Transition.  If not, see <https://www.gnu.org/licenses/>.
+
+pop-transition - Migrate application configuration to Flatpak.
+"""
+
+import errno
+import fcntl
+import fnmatch
+import json
+import os
+import re
+import shutil
+import time
+from logging import getLogger
+from functools import partial
+from threading import Event, Thread
+
+from . import dismissal
+
+# Files are copied in chunks of this size, so that a copy can be cancelled
+# or report progress part-way through a large file.
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How often to report progress, in seconds.
+PROGRESS_INTERVAL = 0.25
+
+# How often to save the manifest while copying, in seconds, so that an
+# interrupted migration can carry on from about where it stopped.
+MANIFEST_INTERVAL = 5
+
+# Bump this whenever the format of the manifest changes.
+MANIFEST_FORMAT = 1
+
+# The ioctl which makes a file share the data of another (a reflink), on
+# filesystems like btrfs and XFS. From linux/fs.h.
+FICLONE = 0x40049409
+
+# Reflinks and copy_file_range() fail with these when the kernel or filesystem
+# can't do them, in which case we fall back to the next way of copying.
+UNSUPPORTED_ERRORS = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF,
+    errno.ENOTTY
+)
+
+# The ways a configuration can be migrated, from cheapest to most expensive.
+STRATEGY_MOVE = 'move'
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_COPY_RANGE = 'copy_file_range'
+STRATEGY_BUFFERED = 'buffered copy'
+
+log = getLogger('pop-transition.migrate')
+
+class MigrationCancelled(Exception):
+    """ Raised when a migration is cancelled part-way through."""
+
+def format_size(size):
+    """ Formats a number of bytes for display, e.g. 1.5 GB."""
+    for unit in ('bytes', 'kB', 'MB', 'GB'):
+        if size < 1000 or unit == 'GB':
+            break
+        size /= 1000
+    if unit == 'bytes':
+        return f'{int(size)} {unit}'
+    return f'{size:.1f} {unit}'
+
+def compile_patterns(patterns):
+    """ Compiles glob patterns for matching paths within a directory.
+
+    A pattern matches the end of a relative path, so 'Cache' matches a Cache
+    directory at any depth, and 'Service Worker/CacheStorage' matches that in
+    any profile.
+
+    Returns:
+        A compiled regular expression, or None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join(
+        f'(?:.*/)?{fnmatch.translate(pattern)}' for pattern in patterns
+    ))
+
+def get_manifest_path(app_id):
+    """ Gets the path of the manifest for migrating an app's configuration."""
+    return dismissal.get_transition_path() / 'migrations' / f'{app_id}.json'
+
+class Migration:
+    """ Copies the configuration directory of one application.
+
+    If a manifest_path is given, the size and modification time of each file
+    copied is recorded there. Running the migration again then only copies
+    the files which have changed or weren't copied yet, so an interrupted
+    migration is resumed and re-running a finished one is nearly instant.
+    Without a manifest, a destination which already exists is left alone.
+
+    Paths matching one of the exclude patterns (see compile_patterns()) are
+    skipped, as are their contents. If there are include patterns, only paths
+    matching one of them, or inside a directory which does, are migrated.
+
+    The cheapest way that works on the filesystem is chosen automatically:
+
+    - If move is True, the directory is renamed, which is instant. This leaves
+      nothing behind for the Debian package, so it's only done when asked to.
+    - Otherwise each file is reflinked, so that it shares its data with the
+      original until either is changed. This needs no extra space.
+    - Otherwise files are copied in chunks with copy_file_range(), which keeps
+      the data in the kernel.
+    - Otherwise they are copied through a large buffer.
+
+    Once one of these fails as unsupported, it isn't tried again.
+
+    Attributes:
+        total_files, total_bytes (int): The size of the source directory, once
+            it's been scanned.
+        copied_files, copied_bytes (int): How much has been copied so far.
+        skipped_files, skipped_bytes (int): How much was unchanged since an
+            earlier run, and so wasn't copied again.
+        excluded ([str]): The paths left out by the exclude patterns.
+        strategy_bytes (dict): How many bytes were migrated with each strategy.
+    """
+
+    def __init__(self, source, dest, cancel=None, move=False,
+                 manifest_path=None, include=None, exclude=None):
+        self.source = os.path.normpath(os.fspath(source))
+        self.dest = os.path.normpath(os.fspath(dest))
+        self.cancel = cancel or Event()
+        self.move = move
+        self.include = compile_patterns(include)
+        self.exclude = compile_patterns(exclude)
+        self.excluded:list = []
+        self.manifest_path = manifest_path
+        self.manifest = None
+        self.last_saved:float = 0
+        self.dirs:list = []
+        self.files:list = []
+        self.links:list = []
+        self.errors:list = []
+        self.total_files:int = 0
+        self.total_bytes:int = 0
+        self.copied_files:int = 0
+        self.copied_bytes:int = 0
+        self.skipped_files:int = 0
+        self.skipped_bytes:int = 0
+        self.strategy_bytes:dict = {}
+        self.use_reflink:bool = True
+        self.use_copy_range:bool = hasattr(os, 'copy_file_range')
+        self.buffer = None
+        self.on_progress = None
+        self.last_progress:float = 0
+
+    @property
+    def fraction(self):
+        """ float: How much of the data has been handled, from 0 to 1."""
+        if not self.total_bytes:
+            return 1.0
+        return (self.copied_bytes + self.skipped_bytes) / self.total_bytes
+
+    @property
+    def strategy(self):
+        """ str: The strategy used for most of the data, if any was copied."""
+        if not self.strategy_bytes:
+            return None
+        return max(self.strategy_bytes, key=self.strategy_bytes.get)
+
+    def scan(self):
+        """ Lists the directories, files and symlinks to copy.
+
+        Paths are stored relative to the source directory, with the size and
+        modification time of each file.
+        """
+        # Each directory to scan, and whether it's inside an included one.
+        pending = [('', self.include is None)]
+        while pending:
+            reldir, included = pending.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.source, reldir)))
+            except OSError as err:
+                self.errors.append((reldir, None, str(err)))
+                continue
+            for entry in entries:
+                relpath = os.path.join(reldir, entry.name)
+                if self.exclude and self.exclude.match(relpath):
+                    self.excluded.append(relpath)
+                    continue
+                matched = included or bool(self.include.match(relpath))
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.dirs.append(relpath)
+                        pending.append((relpath, matched))
+                    elif not matched:
+                        continue
+                    elif entry.is_symlink():
+                        self.links.append(relpath)
+                    elif entry.is_file():
+                        stat = entry.stat(follow_symlinks=False)
+                        self.files.append(
+                            (relpath, stat.st_size, stat.st_mtime_ns)
+                        )
+                        self.total_bytes += stat.st_size
+                except OSError as err:
+                    self.errors.append((entry.path, None, str(err)))
+        self.total_files = len(self.files)
+
+        # Only create the directories which have something included in them.
+        if self.include is not None:
+            needed = set()
+            for relpath in self.links + [file[0] for file in self.files]:
+                parent = os.path.dirname(relpath)
+                while parent and parent not in needed:
+                    needed.add(parent)
+                    parent = os.path.dirname(parent)
+            self.dirs = [
+                relpath for relpath in self.dirs
+                if relpath in needed or self.include.match(relpath)
+            ]
+
+    def run(self, on_progress=None):
+        """ Copies the source directory to the destination.
+
+        Arguments:
+            on_progress: Called with this Migration every PROGRESS_INTERVAL
+                while copying.
+
+        Raises:
+            FileNotFoundError: if there's no source directory.
+            FileExistsError: if the destination already exists, and there's
+                no manifest from migrating to it before.
+            MigrationCancelled: if the cancel Event is set while copying.
+            shutil.Error: listing any files which couldn't be copied, once
+                everything else has been.
+        """
+        self.on_progress = on_progress
+        if not os.path.isdir(self.source):
+            raise FileNotFoundError(
+                errno.ENOENT, 'No configuration to migrate', self.source
+            )
+        self.scan()
+        self.load_manifest()
+        if self.manifest is None:
+            if os.path.lexists(self.dest):
+                raise FileExistsError(
+                    errno.EEXIST, 'Already migrated', self.dest
+                )
+            # Moving takes everything along, so it can't leave paths out.
+            if self.move and self.include is None and self.move_tree():
+                return
+            # Save it before creating anything, so that a migration which is
+            # interrupted straight away can still be resumed.
+            self.manifest = {}
+            self.save_manifest()
+        complete = False
+        try:
+            self.copy_tree()
+            complete = not self.errors
+        finally:
+            self.save_manifest(complete)
+
+        self.report(force=True)
+        if self.errors:
+            raise shutil.Error(self.errors)
+
+    def copy_tree(self):
+        """ Copies everything which isn't already up to date."""
+        os.makedirs(self.dest, exist_ok=True)
+        self.last_saved = time.monotonic()
+
+        # Parents are always listed before their subdirectories.
+        for relpath in self.dirs:
+            os.makedirs(os.path.join(self.dest, relpath), exist_ok=True)
+
+        for relpath in self.links:
+            src = os.path.join(self.source, relpath)
+            dst = os.path.join(self.dest, relpath)
+            if os.path.lexists(dst):
+                continue
+            try:
+                os.symlink(os.readlink(src), dst)
+            except OSError as err:
+                self.errors.append((src, dst, str(err)))
+
+        for relpath, size, mtime in self.files:
+            if self.manifest.get(relpath) == [size, mtime]:
+                self.skipped_files += 1
+                self.skipped_bytes += size
+                continue
+
+            src = os.path.join(self.source, relpath)
+            dst = os.path.join(self.dest, relpath)
+            try:
+                strategy = self.copy_file(src, dst, size)
+                shutil.copystat(src, dst)
+                self.strategy_bytes[strategy] = (
+                    self.strategy_bytes.get(strategy, 0) + size
+                )
+                self.manifest[relpath] = [size, mtime]
+            except MigrationCancelled:
+                raise
+            except OSError as err:
+                self.errors.append((src, dst, str(err)))
+            self.copied_files += 1
+            self.report()
+            if time.monotonic() - self.last_saved >= MANIFEST_INTERVAL:
+                self.save_manifest()
+
+        # Setting a directory's times has to wait until its contents are done.
+        for relpath in reversed([''] + self.dirs):
+            src = os.path.join(self.source, relpath)
+            dst = os.path.join(self.dest, relpath)
+            try:
+                shutil.copystat(src, dst)
+            except OSError as err:
+                self.errors.append((src, dst, str(err)))
+
+    def load_manifest(self):
+        """ Loads the files copied by an earlier run into self.manifest.
+
+        It's left as None if there's no usable manifest for this source and
+        destination, or if the destination has gone since.
+        """
+        if not self.manifest_path or not os.path.isdir(self.dest):
+            return
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+
+        if (manifest.get('format') != MANIFEST_FORMAT
+                or manifest.get('source') != self.source
+                or manifest.get('dest') != self.dest):
+            return
+        if not manifest.get('complete'):
+            log.info('Resuming the migration to %s', self.dest)
+        self.manifest = manifest['files']
+
+    def save_manifest(self, complete=False):
+        """ Saves the files copied so far to the manifest file."""
+        self.last_saved = time.monotonic()
+        if not self.manifest_path or self.manifest is None:
+            return
+        manifest = {
+            'format': MANIFEST_FORMAT,
+            'source': self.source,
+            'dest': self.dest,
+            'complete': complete,
+            'files': self.manifest,
+        }
+        temp_path = f'{self.manifest_path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(temp_path, self.manifest_path)
+        except OSError as err:
+            log.warning('Could not save the migration manifest: %s', err)
+
+    def report(self, force=False):
+        """ Calls on_progress, at most once per PROGRESS_INTERVAL."""
+        if not self.on_progress:
+            return
+        now = time.monotonic()
+        if force or now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            self.on_progress(self)
+
+    def move_tree(self):
+        """ Renames the source directory to the destination.
+
+        Returns:
+            True if it was moved, or False if it's on another filesystem and
+            needs to be copied instead.
+        """
+        if os.path.lexists(self.dest):
+            raise FileExistsError(errno.EEXIST, 'Already migrated', self.dest)
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        try:
+            os.rename(self.source, self.dest)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            log.debug('Can not move %s to another filesystem', self.source)
+            return False
+
+        # Excluded paths are only things the app can regenerate, like caches
+        # and lock files, so they're removed rather than moved along.
+        for relpath in self.excluded:
+            path = os.path.join(self.dest, relpath)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except OSError as err:
+                log.warning('Could not remove %s: %s', path, err)
+
+        self.copied_files = self.total_files
+        self.copied_bytes = self.total_bytes
+        self.strategy_bytes[STRATEGY_MOVE] = self.total_bytes
+        self.report(force=True)
+        return True
+
+    def copy_file(self, src, dst, size):
+        """ Copies the first size bytes of a file.
+
+        Returns:
+            The strategy used to copy it.
+        """
+        self.check_cancelled()
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                return self.copy_fd(src_fd, dst_fd, size)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def copy_fd(self, src_fd, dst_fd, size):
+        """ Copies between open files with the cheapest working strategy."""
+        if self.use_reflink and size:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                self.copied_bytes += size
+                self.report()
+                return STRATEGY_REFLINK
+            except OSError as err:
+                if err.errno not in UNSUPPORTED_ERRORS:
+                    raise
+                log.debug('Reflinks unavailable: %s', err)
+                self.use_reflink = False
+
+        if self.use_copy_range:
+            try:
+                self.copy_range(src_fd, dst_fd, size)
+                return STRATEGY_COPY_RANGE
+            except OSError as err:
+                # Only give up on it if nothing was written yet.
+                if (err.errno not in UNSUPPORTED_ERRORS
+                        or os.lseek(dst_fd, 0, os.SEEK_CUR)):
+                    raise
+                log.debug('copy_file_range() unavailable: %s', err)
+                self.use_copy_range = False
+
+        self.copy_buffered(src_fd, dst_fd, size)
+        return STRATEGY_BUFFERED
+
+    def copy_range(self, src_fd, dst_fd, size):
+        """ Copies a file with copy_file_range()."""
+        remaining = size
+        while remaining > 0:
+            self.check_cancelled()
+            copied = os.copy_file_range(
+                src_fd, dst_fd, min(remaining, COPY_CHUNK_SIZE)
+            )
+            if not copied:
+                break
+            remaining -= copied
+            self.copied_bytes += copied
+            self.report()
+
+    def copy_buffered(self, src_fd, dst_fd, size):
+        """ Copies a file by reading it into a buffer and writing it out."""
+        if self.buffer is None:
+            self.buffer = bytearray(COPY_CHUNK_SIZE)
+        view = memoryview(self.buffer)
+        remaining = size
+        while remaining > 0:
+            self.check_cancelled()
+            length = os.readv(src_fd, [view[:min(remaining, COPY_CHUNK_SIZE)]])
+            if not length:
+                break
+            written = 0
+            while written < length:
+                written += os.write(dst_fd, view[written:length])
+            remaining -= length
+            self.copied_bytes += length
+            self.report()
+
+    def check_cancelled(self):
+        if self.cancel.is_set():
+            raise MigrationCancelled(f'Migration to {self.dest} was cancelled')
+
+def chromium_clean_exit(migration):
+    """ Marks each migrated Chromium profile as having exited cleanly.
+
+    The profile is usually copied from a running browser, which would make the
+    Flatpak offer to restore a crashed session on its first start.
+    """
+    for entry in os.scandir(migration.dest):
+        preferences_path = os.path.join(entry.path, 'Preferences')
+        if not entry.is_dir() or not os.path.isfile(preferences_path):
+            continue
+        with open(preferences_path) as preferences_file:
+            preferences = json.load(preferences_file)
+        profile = preferences.setdefault('profile', {})
+        profile['exit_type'] = 'Normal'
+        profile['exited_cleanly'] = True
+        with open(preferences_path, 'w') as preferences_file:
+            json.dump(preferences, preferences_file)
+
+# Hooks which app definitions can list in 'config_hooks', to run after their
+# configuration has been migrated. Each is called with the Migration.
+HOOKS = {
+    'chromium_clean_exit': chromium_clean_exit,
+}
+
+def run_hooks(names, migration):
+    """ Runs the named HOOKS after a migration, logging any failures."""
+    for name in names:
+        try:
+            HOOKS[name](migration)
+        except Exception as err:
+            log.warning('Migration hook %s failed: %s', name, err)
+
+class MigrateThread(Thread):
+    """ Migrates the configuration of a set of packages in the background.
+
+    Arguments:
+        packages ([PackageRow]): The packages to migrate.
+        move (bool): Whether to move the configuration instead of copying it,
+            when it doesn't need to be kept for the Debian packages.
+        on_progress: Called as on_progress(package, migration) while copying.
+        on_finished: Called as on_finished(package, migration, error) after
+            each package, where error is None or the exception raised.
+    """
+
+    def __init__(self, packages, move=False, on_progress=None,
+                 on_finished=None):
+        super().__init__()
+        self.packages = packages
+        self.move = move
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.cancelled = Event()
+
+    def cancel(self):
+        """ Stop migrating, after the current chunk of data."""
+        self.cancelled.set()
+
+    def run(self):
+        for package in self.packages:
+            if self.cancelled.is_set():
+                break
+            if not (package.old_config and package.new_config):
+                continue
+            if not os.path.isdir(package.old_config):
+                log.debug('No config to migrate for %s', package.name)
+                continue
+
+            migration = Migration(
+                package.old_config, package.new_config, self.cancelled,
+                self.move, get_manifest_path(package.app_id),
+                package.config_include, package.config_exclude
+            )
+            progress = None
+            if self.on_progress:
+                progress = partial(self.on_progress, package)
+
+            error = None
+            start = time.perf_counter()
+            try:
+                migration.run(progress)
+            except shutil.Error as err:
+                error = err
+                log.info(
+                    'Could not copy config for %s from %s to %s.',
+                    package.name, package.old_config, package.new_config
+                )
+            except FileExistsError as err:
+                error = err
+                log.error(
+                    'Config for %s already exists in %s.',
+                    package.name, package.new_config
+                )
+            except (MigrationCancelled, OSError) as err:
+                error = err
+                log.error(
+                    'Could not migrate config for %s: %s', package.name, err
+                )
+            else:
+                run_hooks(package.config_hooks, migration)
+                log.info(
+                    'Migrated %d files (%s) for %s in %.2fs using %s, '
+                    '%d unchanged',
+                    migration.copied_files,
+                    format_size(migration.copied_bytes),
+                    package.name,
+                    time.perf_counter() - start,
+                    migration.strategy,
+                    migration.skipped_files
+                )
+                if migration.excluded:
+                    log.info(
+                        'Left out %d regenerable paths for %s',
+                        len(migration.excluded), package.name
+                    )
+
+            if self.on_finished:
+                self.on_finished(package, migration, error)
+
+def migrate_configs(packages, move=False, on_progress=None, on_finished=None):
+    """ Start migrating the configuration of packages in the background.
+
+    Returns:
+        The running MigrateThread.
+    """
+    thread = MigrateThread(packages, move, on_progress, on_finished)
+    thread.start()
+    return thread
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2020 Ian Santopietro
+Copyright (c) 2020 System76, Inc.
+All rights reserved.
+
+This file is part of Pop-Transition.
+
+    Pop-Transition is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pop-Transition is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pop-Transition.  If not, see <https://www.gnu.org/licenses/>.
+
+pop-transition - Rows displaying packages within the list.
+"""
+
+import gettext
+
+from gi.repository import Gtk, GdkPixbuf, GLib
+
+_ = gettext.gettext
+
+class PackageRow(Gtk.Grid):
+    """ A special class to represent packages within the list.
+
+    This lets us perform actions more easily. The details of the app are kept
+    in self.package, a package.Package record.
+    """
+
+    def __init__(self, package):
+        
+        super().__init__()
+        self.package = package
+
+        self.props.margin = 6
+        self.set_column_spacing(12)
+        self.set_row_spacing(6)
+        self.set_hexpand(True)
+
+        self.checkbox = Gtk.CheckButton()
+        self.attach(self.checkbox, 0, 0, 1, 2)
+
+        self.icon_image = Gtk.Image()
+        self.attach(self.icon_image, 1, 0, 1, 2)
+
+        self.name_label = Gtk.Label()
+        self.name_label.set_valign(Gtk.Align.END)
+        self.name_label.set_yalign(1)
+        self.name_label.set_xalign(0)
+        self.attach(self.name_label, 2, 0, 3, 1)
+
+        self.source_label = Gtk.Label()
+        Gtk.StyleContext.add_class(self.source_label.get_style_context(), 'dim-label')
+        self.source_label.set_halign(Gtk.Align.START)
+        self.source_label.set_valign(Gtk.Align.START)
+        self.source_label.set_yalign(0)
+        self.attach(self.source_label, 2, 1, 1, 1)
+
+        # FIXME: This won't work because AppStream segfaults when getting 
+        # Components. Consider re-adding later.
+        # dash = Gtk.Label.new('-')
+        # Gtk.StyleContext.add_class(dash.get_style_context(), 'dim-label')
+        # dash.set_valign(Gtk.Align.START)
+        # dash.set_yalign(0)
+        # self.attach(dash, 3, 1, 1, 1)
+        #
+        # self.version_label = Gtk.Label()
+        # Gtk.StyleContext.add_class(self.version_label.get_style_context(), 'dim-label')
+        # self.version_label.set_valign(Gtk.Align.START)
+        # self.version_label.set_yalign(0)
+        # self.attach(self.version_label, 2, 1, 1, 1)
+
+        self.status_label = Gtk.Label()
+        self.status_label.set_halign(Gtk.Align.END)
+        self.status_label.set_hexpand(True)
+        self.status_label.set_line_wrap(True)
+        self.status_label.set_xalign(1)
+        Gtk.StyleContext.add_class(self.status_label.get_style_context(), 
+                                   'dim-label')
+        self.attach(self.status_label, 5, 0, 1, 2)
+
+        self.spinner = Gtk.Spinner()
+        self.spinner.set_halign(Gtk.Align.END)
+        self.attach(self.spinner, 6, 0, 1, 2)
+
+        # Only shown while something is downloading
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_no_show_all(True)
+        self.attach(self.progress_bar, 2, 2, 5, 1)
+
+        # Only shown once the configuration starts migrating
+        self.migration_label = Gtk.Label()
+        Gtk.StyleContext.add_class(self.migration_label.get_style_context(),
+                                   'dim-label')
+        self.migration_label.set_xalign(0)
+        self.migration_label.set_no_show_all(True)
+        self.attach(self.migration_label, 2, 3, 5, 1)
+
+        self.name_label.set_text(package.name)
+        self.set_icon(package.icon)
+        self.source = 'Flathub'
+
+    def start_spinner(self):
+        """ Sets this package as busy"""
+        self.spinner.start()
+        
+    def stop_spinner(self):
+        """ Unsets this package as busy"""
+        self.spinner.stop()
+    
+    def set_status_text(self, text):
+        """ Sets the status text."""
+        self.status = text
+    
+    def set_installed_status(self, status):
+        self.package.installed_status = status
+    
+    def set_removed(self, removed):
+        self.package.removed = removed
+
+    def set_progress(self, fraction, text):
+        """ Shows the progress bar with a fraction (0 to 1) complete."""
+        self.progress_bar.set_fraction(fraction)
+        self.progress_bar.set_text(text)
+        self.progress_bar.show()
+
+    def hide_progress(self):
+        """ Hides the progress bar."""
+        self.progress_bar.hide()
+
+    def set_migration_text(self, text):
+        """ Shows how the configuration migration is going."""
+        self.migration_label.set_text(text)
+        self.migration_label.show()
+
+    def set_icon(self, icon):
+        """ Sets the icon from an icon name or the path to an image."""
+        if not icon.startswith('/'):
+            self.icon_image.set_from_icon_name(icon, Gtk.IconSize.DND)
+        else:
+            try:
+                pxbf = GdkPixbuf.Pixbuf.new_from_file_at_size(icon, 32, 32)
+                self.icon_image.set_from_pixbuf(pxbf)
+            except GLib.Error:
+                self.icon_image.set_from_icon_name('image-missing', Gtk.IconSize.DND)
+
+    @property
+    def name(self):
+        """ str: The name of the application. """
+        return self.package.name
+
+    @property
+    def app_id(self):
+        """ str: The RDNN App ID that we're installing as a replacement."""
+        return self.package.app_id
+
+    @property
+    def deb_package(self):
+        """ str: The name of the Debian package."""
+        return self.package.deb_package
+
+    @property
+    def old_config(self):
+        """ str: the path to the old configuration directory."""
+        return self.package.old_config
+
+    @property
+    def new_config(self):
+        """ The path to the flatpak configuration directory."""
+        return self.package.new_config
+
+    @property
+    def config_include(self):
+        """ tuple: Patterns of the configuration to migrate, if limited."""
+        return self.package.config_include
+
+    @property
+    def config_exclude(self):
+        """ tuple: Patterns of the configuration to leave out."""
+        return self.package.config_exclude
+
+    @property
+    def config_hooks(self):
+        """ tuple: Names of the hooks to run after migrating."""
+        return self.package.config_hooks
+
+    @property
+    def installed_status(self):
+        """ str: The installation status of the flatpak package. """
+        return self.package.installed_status
+
+    @property
+    def removed(self):
+        """ bool: Whether the Debian package has been removed."""
+        return self.package.removed
+    
+    @property
+    def source(self):
+        return self.source_label.get_text()
+    
+    @source.setter
+    def source(self, source):
+        self.source_label.set_text(source)
+    
+    @property
+    def status(self):
+        return self.status_label.get_text()
+    
+    @status.setter
+    def status(self, status):
+        self.status_label.set_text(status)
+    
+    @property
+    def busy(self):
+        busy = not self.checkbox.get_sensitive()
+        return busy
+    
+    @busy.setter
+    def busy(self, busy):
+        sensitive = not busy
+        self.checkbox.set_sensitive(sensitive)
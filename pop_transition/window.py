@@ -296,7 +296,7 @@ class Window(Gtk.ApplicationWindow):
             package.checkbox.set_sensitive(sensitive)
         
     def quit_app(self):
-        self.app.quit()
+        self.app.quit_after_migrating()
     
     def set_summary_text(self):
         buffer = self.summary_view.get_buffer()
@@ -383,6 +383,9 @@ class Window(Gtk.ApplicationWindow):
         self.set_visible_buttons()
 
     def show_summary_page(self):
+        # Anything not removed by now keeps its Debian package, so its
+        # configuration is copied instead of moved.
+        self.app.copy_deferred_configs()
         self.content.set_visible_child_name('summary')
         self.set_summary_text()
         self.set_buttons_sensitive(True)
@@ -27,8 +27,11 @@ of packages which were transitioned to Flatpak in Pop_OS 20.04.
 from distutils.core import setup
 from distutils.cmd import Command
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
 def get_version():
     version = {}
@@ -142,6 +145,179 @@ class Test(Command):
         import pop_transition
         pop_transition.run()
 
+# The cold-start time that `pop-transition check` should stay under.
+CHECK_TARGET_MS = 150
+
+# The synthetic browser profile used to time config migration: many small
+# files and a few large ones. As in a real Chromium profile, most of them are
+# caches, with a tenth of the small files and one large file being user data.
+BENCH_PROFILE = {
+    'small_files': 4000,
+    'small_size': 4 * 1024,
+    'large_files': 8,
+    'large_size': 16 * 1024 * 1024,
+}
+
+class Bench(Command):
+    """ Measure the start-up time of the command-line entry points."""
+    description = (
+        'Measure the start-up time of the command-line entry points, and the '
+        'speed of config migration.'
+    )
+
+    user_options = [
+        ('runs=', None, 'Number of times to run each command (default: 5)'),
+    ]
+
+    def initialize_options(self):
+        self.runs = 5
+    
+    def finalize_options(self):
+        self.runs = int(self.runs)
+
+    def time_command(self, command, env):
+        """ Returns the (best, mean) wall-clock time of command, in ms."""
+        times = []
+        for _ in range(self.runs):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, capture_output=True)
+            times.append((time.perf_counter() - start) * 1000)
+        return min(times), sum(times) / len(times)
+
+    def run(self):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.getcwd(), env.get('PYTHONPATH', '')]
+        )
+        script = os.path.join('bin', 'pop-transition')
+
+        # What a full apt cache costs on this machine, for comparison.
+        commands = {
+            'apt Cache()': [
+                sys.executable, '-c', 'from apt.cache import Cache; Cache()'
+            ],
+            'help': [sys.executable, script, '-h'],
+            'check': [sys.executable, script, 'check'],
+            'check --json': [sys.executable, script, 'check', '--json'],
+        }
+
+        print(f'Timing {self.runs} runs of each command')
+        results = {}
+        for name, command in commands.items():
+            best, mean = self.time_command(command, env)
+            results[name] = best
+            print(f'    {name:<16} best {best:8.1f} ms    mean {mean:8.1f} ms')
+
+        # The check must not load any of the GUI or D-Bus modules.
+        loaded = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import sys, pop_transition; pop_transition.run_check(); '
+                'print(" ".join(sorted(m for m in sys.modules '
+                'if m.split(".")[0] in ("gi", "dbus", "repoman"))))'
+            ],
+            env=env, capture_output=True
+        ).stdout.decode('UTF-8').strip()
+        print(f'Modules loaded by check: {loaded or "none of gi, dbus, repoman"}')
+
+        verdict = 'PASS' if results['check'] <= CHECK_TARGET_MS else 'FAIL'
+        print(f'check target {CHECK_TARGET_MS} ms: {verdict}')
+
+        self.bench_migration()
+
+    def make_profile(self, path):
+        """ Fills path with a synthetic profile, returning its size."""
+        total = 0
+        for index in range(BENCH_PROFILE['small_files']):
+            if index % 10:
+                directory = 'Default/Code Cache/js'
+            else:
+                directory = 'Default/Local Storage/leveldb'
+            directory = os.path.join(path, directory, f'{index % 100:02d}')
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f'{index}.ldb'), 'wb') as file:
+                file.write(os.urandom(BENCH_PROFILE['small_size']))
+            total += BENCH_PROFILE['small_size']
+        for index in range(BENCH_PROFILE['large_files']):
+            if index:
+                directory = 'Default/Cache/Cache_Data'
+            else:
+                directory = 'Default'
+            directory = os.path.join(path, directory)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f'History-{index}'), 'wb') as file:
+                file.write(os.urandom(BENCH_PROFILE['large_size']))
+            total += BENCH_PROFILE['large_size']
+        return total
+
+    def bench_migration(self):
+        """ Time migrating a synthetic profile, against shutil.copytree."""
+        from pop_transition import migrate
+
+        with tempfile.TemporaryDirectory() as temp:
+            profile = os.path.join(temp, 'profile')
+            size = self.make_profile(profile)
+            print(
+                f'Migrating a synthetic profile of {migrate.format_size(size)} '
+                f'in {BENCH_PROFILE["small_files"] + BENCH_PROFILE["large_files"]} '
+                'files'
+            )
+
+            def copytree(dest):
+                shutil.copytree(profile, dest)
+                return 'copy2'
+
+            def migration(dest):
+                migration = migrate.Migration(profile, dest)
+                migration.run()
+                return migration.strategy
+
+            for name, copy in (('copytree', copytree), ('migrate', migration)):
+                times = []
+                for run in range(self.runs):
+                    dest = os.path.join(temp, f'{name}-{run}')
+                    start = time.perf_counter()
+                    strategy = copy(dest)
+                    times.append(time.perf_counter() - start)
+                    shutil.rmtree(dest)
+                best = min(times)
+                print(
+                    f'    {name:<16} best {best * 1000:8.1f} ms    '
+                    f'{migrate.format_size(size / best)}/s    ({strategy})'
+                )
+
+            # Running it again with a manifest should only need to scan.
+            dest = os.path.join(temp, 'incremental')
+            manifest = os.path.join(temp, 'manifest.json')
+            migrate.Migration(profile, dest, manifest_path=manifest).run()
+            times = []
+            for run in range(self.runs):
+                migration = migrate.Migration(
+                    profile, dest, manifest_path=manifest
+                )
+                start = time.perf_counter()
+                migration.run()
+                times.append(time.perf_counter() - start)
+            print(
+                f'    {"migrate re-run":<16} best {min(times) * 1000:8.1f} ms    '
+                f'{migration.skipped_files} files unchanged'
+            )
+
+            # Chromium's rules leave out the caches.
+            from pop_transition.apps import APPS
+            dest = os.path.join(temp, 'filtered')
+            migration = migrate.Migration(
+                profile, dest, exclude=APPS['chromium']['config_exclude']
+            )
+            start = time.perf_counter()
+            migration.run()
+            elapsed = time.perf_counter() - start
+            print(
+                f'    {"migrate filtered":<16} once {elapsed * 1000:8.1f} ms    '
+                f'{migrate.format_size(migration.copied_bytes)} in '
+                f'{migration.copied_files} files copied'
+            )
+
 setup(
     name='pop-transition',
     version=get_version(),
@@ -155,6 +331,7 @@ setup(
     license='ISC',
     packages=['pop_transition'],
     cmdclass={
+        'bench': Bench,
         'release': Release,
         'test': Test,
     },